@@ -1,10 +1,14 @@
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
 
 import numpy as np
+import pandas as pd
 from sklearn.mixture import BayesianGaussianMixture
 
 BIRCH_AD_THRESHOLD = 0.1  # 0.045
 CLUSTER_NUMBER = 3
+DISCRETIZATION_RANDOM_STATE = 42
 # BIRCH_AD_THRESHOLD = {"latency": 25, "memory": 100, "cpu": 10}
 logger = logging.getLogger(__name__)
 np.set_printoptions(precision=2)
@@ -25,31 +29,85 @@ def relabel_cluster_ids_by_value(result_distribution, prediction_results, is_rev
 
 
 def discretize_with_trained_mode(metric_data, trained_model):
-    return discretize_with_given_clustering_instances(metric_data, trained_model.clustering_instances,
-                                                      trained_model.sort_indices, trained_model.normalization_factors,
-                                                      trained_model.mean_ground_truth_values)
+    return discretize_with_threshold_tables(metric_data, trained_model.threshold_tables,
+                                            trained_model.mean_ground_truth_values)
 
 
-def discretize_with_given_clustering_instances(metric_data, clustering_instances, sort_indices, normalization_factors,
-                                               mean_ground_truth_values=[]):
-    anomaly_states_by_metric = {}
-    for metric, metric_readings in metric_data.iteritems():
+def discretize_with_threshold_tables(metric_data, threshold_tables, mean_ground_truth_values=[]):
+    metrics = []
+    positions = []
+    for position, metric in enumerate(metric_data.columns):
         if metric.startswith('edgex'):
             continue
-        x = np.array(metric_readings)
-        default_metric_value = mean_ground_truth_values[metric] if metric in mean_ground_truth_values else 0
-        x = np.where(np.isnan(x), default_metric_value, x)
-        if metric not in normalization_factors:
+        if metric not in threshold_tables.metric_indices:
             logger.warning(f"New metric '{metric}' is detected.")
             continue
-        x = x / normalization_factors[metric]
-        x = x.reshape(x.size, 1)
-        prediction_results = clustering_instances[metric].predict(x)
-        new_prediction_results = np.empty_like(prediction_results)
-        for index, value in enumerate(prediction_results):
-            new_prediction_results[index] = sort_indices[metric][value]
-        anomaly_states_by_metric[metric.replace('-', '_')] = new_prediction_results
-    return anomaly_states_by_metric
+        metrics.append(metric)
+        positions.append(position)
+    x = metric_data.to_numpy()[:, positions].astype(float)
+    default_metric_values = np.array([mean_ground_truth_values[metric] if metric in mean_ground_truth_values else 0
+                                      for metric in metrics])
+    x = np.where(np.isnan(x), default_metric_values, x)
+    states = threshold_tables.search(metrics, x)
+    return pd.DataFrame(states, index=metric_data.index, columns=[metric.replace('-', '_') for metric in metrics])
+
+
+def get_normal_states(discrete_data, number_of_initial_steps):
+    # No fault is injected during the initial steps, so their most frequent states are the normal ones
+    metrics = [metric for metric in discrete_data.columns if not metric.startswith('edgex')]
+    return discrete_data[metrics].head(number_of_initial_steps).mode().iloc[0].astype(int).to_dict()
+
+
+def compile_threshold_table(clustering_instance, sort_index, normalization_factor):
+    # Every component's weighted log density is a quadratic of the one-dimensional value, probing it at three points
+    # gives its coefficients and the crossings of two components are the roots of their difference
+    log_probabilities = clustering_instance._estimate_weighted_log_prob(np.array([[-1.0], [0.0], [1.0]]))
+    c = log_probabilities[1]
+    b = (log_probabilities[2] - log_probabilities[0]) / 2
+    a = (log_probabilities[2] + log_probabilities[0]) / 2 - c
+    crossings = []
+    for i, j in combinations(range(c.size), 2):
+        roots = np.roots([a[i] - a[j], b[i] - b[j], c[i] - c[j]])
+        crossings.extend(roots[np.isreal(roots)].real)
+    crossings = np.unique(crossings)
+    if crossings.size == 0:
+        probes = np.zeros(1)
+    else:
+        probes = np.concatenate([[crossings[0] - 1], (crossings[:-1] + crossings[1:]) / 2, [crossings[-1] + 1]])
+    labels = clustering_instance.predict(probes.reshape(-1, 1))
+    # Crossings between two components which never win there do not change the prediction
+    changes = np.flatnonzero(labels[1:] != labels[:-1])
+    boundaries = crossings[changes] * normalization_factor
+    states = np.asarray(sort_index)[labels[np.concatenate([[0], changes + 1])]]
+    if normalization_factor < 0:
+        boundaries, states = boundaries[::-1], states[::-1]
+    return boundaries, states
+
+
+def compile_threshold_tables(clustering_instances, sort_indices, normalization_factors):
+    return ThresholdTables({metric: compile_threshold_table(clustering_instance, sort_indices[metric],
+                                                            normalization_factors[metric])
+                            for metric, clustering_instance in clustering_instances.items()})
+
+
+class ThresholdTables:
+
+    def __init__(self, tables):
+        self.metrics = list(tables)
+        self.metric_indices = {metric: index for index, metric in enumerate(self.metrics)}
+        max_boundaries = max((boundaries.size for boundaries, _ in tables.values()), default=0)
+        # Missing boundaries are padded with infinity so that the last state is kept for larger values
+        self.boundaries = np.full((len(self.metrics), max_boundaries), np.inf)
+        self.states = np.zeros((len(self.metrics), max_boundaries + 1), dtype=np.int8)
+        for index, (boundaries, states) in enumerate(tables.values()):
+            self.boundaries[index, :boundaries.size] = boundaries
+            self.states[index, :states.size] = states
+
+    def search(self, metrics, values):
+        indices = [self.metric_indices[metric] for metric in metrics]
+        # Counting the boundaries at or below each value is np.searchsorted(side='right') for all metrics at once
+        intervals = (values[:, :, np.newaxis] >= self.boundaries[indices][np.newaxis]).sum(axis=2)
+        return self.states[indices][np.arange(len(indices)), intervals]
 
 
 def check_multiple_clusters_exists_in_base_data(prediction_results, base_data_size):
@@ -63,16 +121,16 @@ def check_multi_clusters_exists(prediction_results):
 
 
 def cluster_data(metric, normalized_metric_readings, birch_threshold, base_data_size, no_cluster_found=False,
-                 n_components=CLUSTER_NUMBER):
+                 n_components=CLUSTER_NUMBER, random_state=DISCRETIZATION_RANDOM_STATE):
     # brc = Birch(branching_factor=50, n_clusters=CLUSTER_NUMBER, threshold=birch_threshold, compute_labels=True)
     # brc = DBSCAN(eps=0.1, min_samples=5)
-    brc = BayesianGaussianMixture(n_components=n_components)
+    brc = BayesianGaussianMixture(n_components=n_components, random_state=random_state)
     brc.fit(normalized_metric_readings)
     prediction_results = brc.predict(normalized_metric_readings)
     n_clusters = np.unique(prediction_results).size
     if n_clusters != n_components:
         return cluster_data(metric, normalized_metric_readings, birch_threshold, base_data_size, no_cluster_found=False,
-                            n_components=n_clusters)
+                            n_components=n_clusters, random_state=random_state)
     # prediction_results = brc.fit_predict(normalized_metric_readings)
     # if check_multiple_clusters_exists_in_base_data(prediction_results, base_data_size) and not no_cluster_found:
     #     new_threshold = birch_threshold * 1.05
@@ -86,87 +144,98 @@ def cluster_data(metric, normalized_metric_readings, birch_threshold, base_data_
     return brc, prediction_results
 
 
-def discretize(metric_data, birch_threshold=BIRCH_AD_THRESHOLD, base_data_size=30):
+def discretize(metric_data, birch_threshold=BIRCH_AD_THRESHOLD, base_data_size=30, n_workers=1,
+               random_state=DISCRETIZATION_RANDOM_STATE):
     anomaly_states_by_metric = {}
     clustering_instances = {}
     sort_indices = {}
     normalization_factors = {}
     metrics = list(metric_data.columns)
     metrics.sort()
-    for metric in metrics:
-        is_reverse = False
-        if metric.startswith('availability'):
-            is_reverse = True
-        metric_readings = metric_data[metric]
-        result_distribution = {}
-        if metric.startswith('edgex') or metric.startswith('timestamp'):
-            continue
-        np_metric_readings = np.array(metric_readings)
-        if np_metric_readings.max() <= 1 and np_metric_readings.min() >= 0:
-            # logger.info(f"No normalization for {metric}")
-            normalization_factors[metric] = 1
-            np_metric_readings = np_metric_readings.reshape(-1, 1)
-        else:
-            # np_metric_readings = np.where(np.isnan(np_metric_readings), 0, np_metric_readings)
-            normalization_factor = np_metric_readings.mean()
-            normalized_metric_readings = np_metric_readings / normalization_factor
-            std_deviation = normalized_metric_readings.std()
-            birch_threshold = std_deviation if std_deviation > 0 else BIRCH_AD_THRESHOLD
-            # normalized_metric_readings = preprocessing.normalize([np_metric_readings], norm="max")
-            # if normalized_metric_readings[0, 0] == 0:
-            #     nonzero_value_index = next((i for i, x in enumerate(normalized_metric_readings[0, :]) if x), None)
-            #     if nonzero_value_index is None:
-            #         logger.warning(f"Ignoring {metric} since it is zero")
-            #         normalization_factor = 1
-            #     else:
-            #         logger.info(
-            #             f"First nonzero value is at {nonzero_value_index} and "
-            #             f"it is {np_metric_readings[nonzero_value_index]}")
-            #         normalization_factor = np_metric_readings[nonzero_value_index] / normalized_metric_readings[
-            #             0, nonzero_value_index]
-            #
-            # else:
-            #     normalization_factor = np_metric_readings[0] / normalized_metric_readings[0, 0]
-            # logger.info(f"Normalization factor is {normalization_factor}")
-            # logger.info(f"birch_threshold is {birch_threshold}")
-            normalization_factors[metric] = normalization_factor
-            np_metric_readings = normalized_metric_readings.reshape(-1, 1)
-        # birch_threshold = BIRCH_AD_THRESHOLD[metric.split("_")[0]]
-        try:
-            brc, prediction_results = cluster_data(metric, np_metric_readings, birch_threshold, base_data_size)
-        except:
-            pass
-        for index, result in enumerate(prediction_results):
-            if result in result_distribution:
-                result_distribution[result].append(metric_readings[index])
-            else:
-                result_distribution[result] = [metric_readings[index]]
-
-        n_clusters = np.unique(prediction_results).size
-        logger.debug(f"{metric}: size={n_clusters}")
-        for cluster_id, cluster_values in result_distribution.items():
-            min_value, max_value = (round(min(cluster_values), 2), round(max(cluster_values), 2))
-            if min_value == max_value:
-                range_text = str(min_value)
-            else:
-                range_text = f"{min_value},{max_value}"
-            rounded_values = [int(round(i, 0)) for i in cluster_values if not np.isnan(i)]
-            unique_values = list(set(rounded_values))
-            unique_values.sort()
-            value_counter = {value: rounded_values.count(value) for value in unique_values}
-            # logger.info(
-            #     f"{cluster_id}:({range_text}) {[round(i, 2) for i in cluster_values]}")
-            logger.debug(
-                f"{cluster_id}<{len(cluster_values)}>:({range_text}) {value_counter}")
-        prediction_results, sort_index = relabel_cluster_ids_by_value(result_distribution, prediction_results,
-                                                                      is_reverse=is_reverse)
-        pairs = "\n"
-        for i in range(len(metric_readings)):
-            pairs += f"{round(float(metric_readings[i]), 2)}|{prediction_results[i]}\t"
-            if i % 10 == 9:
-                pairs += "\n"
-        logger.debug(pairs)
+    metrics = [metric for metric in metrics if not metric.startswith('edgex') and not metric.startswith('timestamp')]
+    metric_arguments = [(metric, np.array(metric_data[metric]), birch_threshold, base_data_size, random_state)
+                        for metric in metrics]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(discretize_metric, *zip(*metric_arguments)))
+    else:
+        results = [discretize_metric(*arguments) for arguments in metric_arguments]
+    for metric, (prediction_results, brc, sort_index, normalization_factor) in zip(metrics, results):
         anomaly_states_by_metric[metric] = prediction_results
         clustering_instances[metric] = brc
         sort_indices[metric] = sort_index
+        normalization_factors[metric] = normalization_factor
     return anomaly_states_by_metric, clustering_instances, sort_indices, normalization_factors
+
+
+def discretize_metric(metric, metric_readings, birch_threshold, base_data_size, random_state):
+    is_reverse = False
+    if metric.startswith('availability'):
+        is_reverse = True
+    result_distribution = {}
+    np_metric_readings = np.array(metric_readings)
+    if np_metric_readings.max() <= 1 and np_metric_readings.min() >= 0:
+        # logger.info(f"No normalization for {metric}")
+        normalization_factor = 1
+        np_metric_readings = np_metric_readings.reshape(-1, 1)
+    else:
+        # np_metric_readings = np.where(np.isnan(np_metric_readings), 0, np_metric_readings)
+        normalization_factor = np_metric_readings.mean()
+        normalized_metric_readings = np_metric_readings / normalization_factor
+        std_deviation = normalized_metric_readings.std()
+        birch_threshold = std_deviation if std_deviation > 0 else BIRCH_AD_THRESHOLD
+        # normalized_metric_readings = preprocessing.normalize([np_metric_readings], norm="max")
+        # if normalized_metric_readings[0, 0] == 0:
+        #     nonzero_value_index = next((i for i, x in enumerate(normalized_metric_readings[0, :]) if x), None)
+        #     if nonzero_value_index is None:
+        #         logger.warning(f"Ignoring {metric} since it is zero")
+        #         normalization_factor = 1
+        #     else:
+        #         logger.info(
+        #             f"First nonzero value is at {nonzero_value_index} and "
+        #             f"it is {np_metric_readings[nonzero_value_index]}")
+        #         normalization_factor = np_metric_readings[nonzero_value_index] / normalized_metric_readings[
+        #             0, nonzero_value_index]
+        #
+        # else:
+        #     normalization_factor = np_metric_readings[0] / normalized_metric_readings[0, 0]
+        # logger.info(f"Normalization factor is {normalization_factor}")
+        # logger.info(f"birch_threshold is {birch_threshold}")
+        np_metric_readings = normalized_metric_readings.reshape(-1, 1)
+    # birch_threshold = BIRCH_AD_THRESHOLD[metric.split("_")[0]]
+    try:
+        brc, prediction_results = cluster_data(metric, np_metric_readings, birch_threshold, base_data_size,
+                                               random_state=random_state)
+    except:
+        pass
+    for index, result in enumerate(prediction_results):
+        if result in result_distribution:
+            result_distribution[result].append(metric_readings[index])
+        else:
+            result_distribution[result] = [metric_readings[index]]
+
+    n_clusters = np.unique(prediction_results).size
+    logger.debug(f"{metric}: size={n_clusters}")
+    for cluster_id, cluster_values in result_distribution.items():
+        min_value, max_value = (round(min(cluster_values), 2), round(max(cluster_values), 2))
+        if min_value == max_value:
+            range_text = str(min_value)
+        else:
+            range_text = f"{min_value},{max_value}"
+        rounded_values = [int(round(i, 0)) for i in cluster_values if not np.isnan(i)]
+        unique_values = list(set(rounded_values))
+        unique_values.sort()
+        value_counter = {value: rounded_values.count(value) for value in unique_values}
+        # logger.info(
+        #     f"{cluster_id}:({range_text}) {[round(i, 2) for i in cluster_values]}")
+        logger.debug(
+            f"{cluster_id}<{len(cluster_values)}>:({range_text}) {value_counter}")
+    prediction_results, sort_index = relabel_cluster_ids_by_value(result_distribution, prediction_results,
+                                                                  is_reverse=is_reverse)
+    pairs = "\n"
+    for i in range(len(metric_readings)):
+        pairs += f"{round(float(metric_readings[i]), 2)}|{prediction_results[i]}\t"
+        if i % 10 == 9:
+            pairs += "\n"
+    logger.debug(pairs)
+    return prediction_results, brc, sort_index, normalization_factor
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import math
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+
+import config as c
+from metric import prometheus_range_query, get_response_times_query, get_request_error_rates_query, \
+    get_container_availabilities_query, get_container_cpu_usages_query, get_container_memory_usages_query, \
+    get_latency_metric_name, get_error_metric_name
+from dataset_storage import write_dataset, ARROW_FILE_EXTENSION
+from rca import FAULT_STATUS, FAULT_SAMPLE_DELAY, store_metrics_to_files
+
+RANGE_QUERY_RESOLUTION = 15
+# Prometheus refuses range queries returning more than 11000 points per series
+MAX_POINTS_PER_QUERY = 11000
+METRIC_FAMILY_QUERIES = {
+    "latency": get_response_times_query,
+    "error": get_request_error_rates_query,
+    "availability": get_container_availabilities_query,
+    "cpu": get_container_cpu_usages_query,
+    "memory": get_container_memory_usages_query,
+}
+CONTAINER_LABELS = {"availability": "org_edgexfoundry_service", "cpu": "container", "memory": "container"}
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='Rebuild a training dataset from Prometheus range queries')
+
+    parser.add_argument('--config', type=str, required=False,
+                        default='config.yaml',
+                        help='Location of config file')
+    parser.add_argument('--experiment-log', type=str, required=True,
+                        help='chaos mesh experiment log (step, service, fault_type, start_time, end_time)')
+    parser.add_argument('--output', type=str, required=False,
+                        default=f"dataset/training_data_{time.strftime('%Y%m%d-%H%M%S')}.csv",
+                        help='csv or arrow file to store the rebuilt dataset')
+    parser.add_argument('--resolution', type=int, required=False,
+                        default=RANGE_QUERY_RESOLUTION,
+                        help='step of the range queries in seconds')
+    parser.add_argument('--recorded', type=str, required=False,
+                        help='replay the range query responses from this file instead of querying Prometheus')
+    parser.add_argument('--record', type=str, required=False,
+                        help='store the range query responses to this file')
+    return parser.parse_args()
+
+
+def convert_to_epoch(time_value):
+    try:
+        return float(time_value)
+    except ValueError:
+        return pd.Timestamp(time_value, tz="UTC").timestamp()
+
+
+def read_experiment_log(filename):
+    experiment_log = pd.read_csv(filename, dtype={"service": str, "fault_type": str})
+    if "step" not in experiment_log:
+        experiment_log["step"] = range(len(experiment_log))
+    experiment_log["start_time"] = experiment_log["start_time"].map(convert_to_epoch)
+    experiment_log["end_time"] = experiment_log["end_time"].map(convert_to_epoch)
+    experiment_log["fault_status"] = [int(fault_type) if fault_type.isdigit() else FAULT_STATUS[fault_type]
+                                      for fault_type in experiment_log["fault_type"]]
+    return experiment_log
+
+
+def get_sample_times(experiment_log, number_of_initial_steps, step_interval):
+    samples = []
+    first_start_time = experiment_log["start_time"].min()
+    for step_index in range(number_of_initial_steps):
+        samples.append((first_start_time - step_interval * (number_of_initial_steps - step_index), {}))
+    for step_no, step_experiments in experiment_log.groupby("step", sort=True):
+        # Same waiting time as in data collection, unless the experiment ends before
+        sample_time = min(step_experiments["start_time"].max() + FAULT_SAMPLE_DELAY,
+                          step_experiments["end_time"].min())
+        services_with_anomaly = dict(zip(step_experiments["service"], step_experiments["fault_status"]))
+        samples.append((sample_time, services_with_anomaly))
+    return samples
+
+
+def merge_range_results(all_results, new_results):
+    for result in new_results:
+        series_key = json.dumps(result["metric"], sort_keys=True)
+        if series_key in all_results:
+            all_results[series_key]["values"].extend(result["values"])
+        else:
+            all_results[series_key] = {"metric": result["metric"], "values": list(result["values"])}
+
+
+def query_metric_family(prom_url, query, start_time, end_time, resolution):
+    all_results = {}
+    chunk_length = resolution * (MAX_POINTS_PER_QUERY - 1)
+    chunk_start_time = start_time
+    while chunk_start_time <= end_time:
+        chunk_end_time = min(chunk_start_time + chunk_length, end_time)
+        merge_range_results(all_results,
+                            prometheus_range_query(prom_url, query, chunk_start_time, chunk_end_time, resolution))
+        chunk_start_time = chunk_end_time + resolution
+    return list(all_results.values())
+
+
+def fetch_metric_families(config, start_time, end_time, resolution):
+    responses = {}
+    for family, query_method in METRIC_FAMILY_QUERIES.items():
+        query_start_time = time.time()
+        responses[family] = query_metric_family(config['prometheus_url'], query_method(), start_time, end_time,
+                                                resolution)
+        logger.info(f"Retrieved {len(responses[family])} {family} series in {time.time() - query_start_time:.3f}s")
+    return responses
+
+
+def convert_to_frame(results, get_metric_name):
+    series_by_name = {}
+    for result in results:
+        name = get_metric_name(result["metric"])
+        if name is None:
+            continue
+        timestamps = np.array([value[0] for value in result["values"]], dtype=float)
+        values = np.array([np.NaN if value[1] == "NaN" else value[1] for value in result["values"]], dtype=float)
+        series_by_name[name] = pd.Series(values, index=timestamps)
+    return pd.DataFrame(series_by_name).sort_index()
+
+
+def align_to_sample_times(frame, sample_times, resolution):
+    # Take the latest evaluation of the grid at or before each sample time
+    return frame.reindex(sample_times, method="pad", tolerance=resolution)
+
+
+def build_training_dataframe(config, responses, samples, resolution):
+    sample_times = [sample_time for sample_time, _ in samples]
+    frames = {
+        "latency": convert_to_frame(responses["latency"], lambda metric: get_latency_metric_name(config, metric)),
+        "error": convert_to_frame(responses["error"], lambda metric: get_error_metric_name(config, metric)),
+    }
+    for family, label in CONTAINER_LABELS.items():
+        frames[family] = convert_to_frame(responses[family], lambda metric: metric.get(label))
+    frames = {family: align_to_sample_times(frame, sample_times, resolution) for family, frame in frames.items()}
+
+    columns = {"timestamp": pd.to_datetime(np.floor(sample_times), unit="s")}
+    for name in frames["latency"].columns:
+        columns[name] = frames["latency"][name].to_numpy()
+    container_names = set(frames["availability"].columns) | set(frames["cpu"].columns) | set(
+        frames["memory"].columns)
+    for container_name in sorted(container_names):
+        if container_name in config["services_skipped"]:
+            continue
+        columns[container_name] = [services_with_anomaly.get(container_name, 0) for _, services_with_anomaly in
+                                   samples]
+        for family in CONTAINER_LABELS:
+            if container_name in frames[family]:
+                columns[f"{family}_{container_name}"] = frames[family][container_name].to_numpy()
+            else:
+                columns[f"{family}_{container_name}"] = np.NaN
+    for name in frames["error"].columns:
+        columns[name] = frames["error"][name].to_numpy()
+    return pd.DataFrame(columns)
+
+
+def remove_columns_empty_in_initial_steps(training_dataframe, number_of_initial_steps):
+    initial_rows = training_dataframe.head(number_of_initial_steps)
+    empty_columns = [column for column in training_dataframe.columns if initial_rows[column].isna().all()]
+    if empty_columns:
+        logger.info(f"Columns with only NaN values in initial steps are removed: {empty_columns}")
+    return training_dataframe.drop(columns=empty_columns)
+
+
+def backfill(config, experiment_log_filename, output_filename, resolution=RANGE_QUERY_RESOLUTION,
+             recorded_filename=None, record_filename=None):
+    experiment_log = read_experiment_log(experiment_log_filename)
+    samples = get_sample_times(experiment_log, config["number_of_initial_steps"], config["step_interval"])
+    if recorded_filename:
+        with open(recorded_filename) as recorded_file:
+            recorded_data = json.load(recorded_file)
+        resolution = recorded_data["resolution"]
+        responses = recorded_data["responses"]
+        logger.info(f"Replaying range query responses from {recorded_filename}")
+    else:
+        start_time = math.floor(samples[0][0] - resolution)
+        end_time = math.ceil(samples[-1][0])
+        responses = fetch_metric_families(config, start_time, end_time, resolution)
+        if record_filename:
+            with open(record_filename, "w") as record_file:
+                json.dump({"resolution": resolution, "start_time": start_time, "end_time": end_time,
+                           "responses": responses}, record_file)
+            logger.info(f"Range query responses are recorded to {record_filename}")
+    training_dataframe = build_training_dataframe(config, responses, samples, resolution)
+    training_dataframe = remove_columns_empty_in_initial_steps(training_dataframe, config["number_of_initial_steps"])
+    if output_filename.endswith(ARROW_FILE_EXTENSION):
+        write_dataset(output_filename, training_dataframe)
+    else:
+        store_metrics_to_files(training_dataframe, output_filename)
+    logger.info(f"Stored {training_dataframe.shape[0]} rows with {training_dataframe.shape[1]} columns "
+                f"to {output_filename}")
+    return training_dataframe
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=getattr(logging, c.LOG_LEVEL),
+                        format=c.LOGGING_FORMAT, datefmt=c.TIME_FORMAT)
+    with open(args.config) as f:
+        config_from_yaml = yaml.load(f, Loader=yaml.FullLoader)
+    backfill(config_from_yaml, args.experiment_log, args.output, resolution=args.resolution,
+             recorded_filename=args.recorded, record_filename=args.record)
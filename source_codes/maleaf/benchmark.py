@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+import pandas as pd
+import yaml
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
+
+import config as c
+from anomaly_detection import discretize_with_trained_mode
+from data_manipulation import filter_data, remove_majorly_empty_columns, make_service_columns_binary, \
+    remove_columns_unavailable_on_training_data, filter_columns_by_inference_engine
+from generate_model import train_model, get_raw_data
+from causalnex.structure.notears import from_pandas
+from metric import convert_to_latency_values, convert_to_error_rates, convert_to_usage_by_container, \
+    convert_to_availability_by_container, aggregate_metric_services
+from models.compiled_predictor import CompiledRandomForest, CompiledSVM
+from models.trained_model_cbn import TrainedModelCBN, ApproximateInferenceEngine
+from rca import create_row_dataframe
+
+STEP_PARSING_SERIES_COUNTS = [50, 500, 5000]
+# (rows, metric columns) pairs, growing the rows and the columns separately
+PREPROCESSING_SHAPES = [(25000, 1000), (50000, 1000), (100000, 250), (100000, 500), (100000, 1000)]
+PREPROCESSING_SERVICE_COUNT = 10
+PREPROCESSING_EMPTY_RATIO = 0.05
+STRUCTURE_LEARNING_SERVICE_COUNTS = [5, 10, 20]
+STRUCTURE_LEARNING_ROWS = 500
+WEAK_LINK_THRESHOLD = 0.05
+APPROXIMATE_INFERENCE_SAMPLE_SIZES = [500, 5000, 50000]
+APPROXIMATE_INFERENCE_TEST_STEPS = 40
+# (rows, metric columns, services) of the synthetic classifier training data
+PREDICTION_SHAPE = (3000, 40, 8)
+PREDICTION_SVM_ROWS = 800
+PROMETHEUS_TIMESTAMP = 1704812400.123
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """Parse the args."""
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the MALEAF processing stages')
+
+    parser.add_argument('--benchmark', type=str, required=False,
+                        default='all', choices=['all'] + list(BENCHMARKS),
+                        help='benchmark to run')
+    parser.add_argument('--repeat', type=int, required=False,
+                        default=20,
+                        help='number of measured repetitions')
+    return parser.parse_args()
+
+
+def measure(method, *args, repeat=20):
+    method(*args)
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        method(*args)
+    return (time.perf_counter() - start_time) / repeat
+
+
+def create_prometheus_result(labels):
+    return {"metric": labels, "value": [PROMETHEUS_TIMESTAMP, f"{random.uniform(0, 100):.3f}"]}
+
+
+def create_synthetic_step_results(number_of_series):
+    # Latency edges dominate the step, the rest is split between the per service families
+    number_of_services = max(1, number_of_series // 10)
+    number_of_edges = number_of_series - 4 * number_of_services
+    services = [f"edgex-service-{index}" for index in range(number_of_services)]
+    return {
+        "latency": [create_prometheus_result({"source_workload": services[index % number_of_services],
+                                              "destination_workload": f"edgex-target-{index}"})
+                    for index in range(number_of_edges)],
+        "error": [create_prometheus_result({"destination_service_name": service}) for service in services],
+        "availability": [create_prometheus_result({"org_edgexfoundry_service": service}) for service in services],
+        "cpu": [create_prometheus_result({"container": service}) for service in services],
+        "memory": [create_prometheus_result({"container": service}) for service in services],
+    }
+
+
+def parse_step_results(config, step_results, services_with_anomaly):
+    latency_values = convert_to_latency_values(config, step_results["latency"])
+    request_error_rates = convert_to_error_rates(config, step_results["error"])
+    service_dict_temp = aggregate_metric_services(config,
+                                                  convert_to_availability_by_container(step_results["availability"]),
+                                                  convert_to_usage_by_container(step_results["cpu"]),
+                                                  convert_to_usage_by_container(step_results["memory"]))
+    return create_row_dataframe(latency_values, service_dict_temp, request_error_rates, services_with_anomaly)
+
+
+def benchmark_step_parsing(repeat):
+    config = {"services_skipped": []}
+    for number_of_series in STEP_PARSING_SERIES_COUNTS:
+        step_results = create_synthetic_step_results(number_of_series)
+        services_with_anomaly = {"edgex-service-0": 1}
+        duration = measure(parse_step_results, config, step_results, services_with_anomaly, repeat=repeat)
+        number_of_columns = parse_step_results(config, step_results, services_with_anomaly).shape[1]
+        logger.info(f"Step parsing of {number_of_series} series ({number_of_columns} columns): "
+                    f"{duration * 1000:.3f} ms per step")
+
+
+def create_synthetic_training_data(number_of_rows, number_of_metrics):
+    rng = np.random.default_rng(0)
+    metrics = rng.uniform(0, 100, (number_of_rows, number_of_metrics))
+    metrics[rng.random(metrics.shape) < PREPROCESSING_EMPTY_RATIO] = np.NaN
+    training_data = pd.DataFrame(metrics, columns=[f"latency_edgex-service-{index % PREPROCESSING_SERVICE_COUNT}_{index}"
+                                                   for index in range(number_of_metrics)])
+    # Mostly normal steps, otherwise one of the fault types
+    for index in range(PREPROCESSING_SERVICE_COUNT):
+        training_data[f"edgex-service-{index}"] = rng.choice(5, number_of_rows, p=[0.9, 0.025, 0.025, 0.025, 0.025])
+    return training_data
+
+
+def preprocess(config, training_data, number_of_initial_steps):
+    training_data = filter_data(config, training_data.copy())
+    training_data, _ = remove_majorly_empty_columns(training_data, number_of_initial_steps)
+    return make_service_columns_binary(training_data)
+
+
+def benchmark_preprocessing(repeat):
+    config = {"services_skipped": ["edgex-service-0"],
+              "services_for_fault_injection": [f"edgex-service-{index}" for index in
+                                               range(1, PREPROCESSING_SERVICE_COUNT)],
+              "metrics_skipped": ["error"],
+              "experiments_skipped": {"cpu": 2}}
+    for number_of_rows, number_of_metrics in PREPROCESSING_SHAPES:
+        training_data = create_synthetic_training_data(number_of_rows, number_of_metrics)
+        duration = measure(preprocess, config, training_data, 15, repeat=max(1, repeat // 10))
+        logger.info(f"Preprocessing of {number_of_rows} rows and {number_of_metrics} columns: {duration:.3f} s "
+                    f"({duration * 1e9 / (number_of_rows * number_of_metrics):.1f} ns per cell)")
+
+
+def create_synthetic_discrete_data(number_of_services, number_of_rows):
+    # A chain of services, each with a fault status and metrics that react to its own and its neighbours' faults
+    rng = np.random.default_rng(0)
+    services = [f"edgex_service_{index}" for index in range(number_of_services)]
+    statuses = rng.choice(2, (number_of_rows, number_of_services), p=[0.8, 0.2])
+    training_data = pd.DataFrame(statuses, columns=services)
+    for index, service_name in enumerate(services):
+        neighbour_statuses = statuses[:, max(0, index - 1):index + 2].sum(axis=1)
+        for prefix in ["cpu_", "memory_", "availability_"]:
+            training_data[f"{prefix}{service_name}"] = np.clip(
+                statuses[:, index] + rng.choice(2, number_of_rows, p=[0.9, 0.1]), 0, 2)
+        if index + 1 < number_of_services:
+            training_data[f"latency_{service_name}_{services[index + 1]}"] = np.clip(
+                neighbour_statuses + rng.choice(2, number_of_rows, p=[0.9, 0.1]), 0, 2)
+    return training_data, services
+
+
+def benchmark_cbn_structure_learning(repeat):
+    for number_of_services in STRUCTURE_LEARNING_SERVICE_COUNTS:
+        training_data, services = create_synthetic_discrete_data(number_of_services, STRUCTURE_LEARNING_ROWS)
+        metrics = list(set(training_data.columns) - set(services))
+        service_graph = TrainedModelCBN.get_service_graph({"services_for_fault_injection": services,
+                                                           "service_graph_file": ""}, training_data.columns)
+        structure_learners = {
+            "notears": lambda: from_pandas(training_data, tabu_child_nodes=services, tabu_parent_nodes=metrics,
+                                           max_iter=1000),
+            "service_graph": lambda: TrainedModelCBN.learn_from_service_graph(training_data, services, service_graph),
+        }
+        for structure_learning, learn in structure_learners.items():
+            duration = measure(learn, repeat=max(1, repeat // 10))
+            weights = [weight for _, _, weight in learn().edges(data="weight")]
+            logger.info(f"Structure learning with {structure_learning} on {training_data.shape[1]} columns: "
+                        f"{duration:.3f} s, {len(weights)} edges, "
+                        f"{sum(abs(weight) >= WEAK_LINK_THRESHOLD for weight in weights)} above the weak link threshold")
+
+
+def get_discrete_test_steps(config, trained_model, number_of_steps):
+    test_data, _ = get_raw_data(config, is_test_data=True)
+    test_data = filter_data(config, test_data)
+    test_data.columns = test_data.columns.str.replace('-', '_')
+    test_data = remove_columns_unavailable_on_training_data(test_data, trained_model.training_data)
+    discrete_test_data = discretize_with_trained_mode(test_data.drop(columns="timestamp"), trained_model)
+    return [{metric: state for metric, state in step.items() if not metric.startswith("edgex")}
+            for step in discrete_test_data.head(number_of_steps).to_dict("records")]
+
+
+def query_all_engines(inference_engines, discrete_test_steps):
+    return [[inference_engine.query(filter_columns_by_inference_engine(step, inference_engine))
+             for inference_engine in inference_engines] for step in discrete_test_steps]
+
+
+def compare_fault_distributions(exact_results, approximate_results):
+    errors = []
+    matched = 0
+    for exact_step_results, approximate_step_results in zip(exact_results, approximate_results):
+        for exact_result, approximate_result in zip(exact_step_results, approximate_step_results):
+            for node, exact_distribution in exact_result.items():
+                if not node.startswith("edgex"):
+                    continue
+                approximate_distribution = approximate_result[node]
+                errors.append(max(abs(exact_distribution[state] - approximate_distribution[state])
+                                  for state in exact_distribution))
+                matched += max(exact_distribution, key=exact_distribution.get) == \
+                    max(approximate_distribution, key=approximate_distribution.get)
+    return np.mean(errors), np.max(errors), matched / len(errors)
+
+
+def benchmark_approximate_inference(repeat):
+    # Stored datasets of config.yaml, the exact engines are the reference
+    with open('config.yaml') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config.update({"rca_algorithm": "cbn", "cbn_inference": "exact"})
+    trained_model = train_model(config)
+    discrete_test_steps = get_discrete_test_steps(config, trained_model, APPROXIMATE_INFERENCE_TEST_STEPS)
+    exact_engines = [inference_engine.inference_engine for inference_engine in trained_model.inference_engines]
+    start_time = time.perf_counter()
+    exact_results = query_all_engines(exact_engines, discrete_test_steps)
+    logger.info(f"Exact inference: {(time.perf_counter() - start_time) * 1000 / len(discrete_test_steps):.3f} ms "
+                f"per step")
+    for sample_size in APPROXIMATE_INFERENCE_SAMPLE_SIZES:
+        approximate_engines = [ApproximateInferenceEngine(bn, sample_size, None)
+                               for bn in trained_model.bayesian_networks]
+        start_time = time.perf_counter()
+        approximate_results = query_all_engines(approximate_engines, discrete_test_steps)
+        duration = (time.perf_counter() - start_time) / len(discrete_test_steps)
+        mean_error, max_error, matched_ratio = compare_fault_distributions(exact_results, approximate_results)
+        logger.info(f"Likelihood weighting with {sample_size} samples: {duration * 1000:.3f} ms per step, "
+                    f"mean error {mean_error:.4f}, max error {max_error:.4f}, "
+                    f"same most likely fault for {matched_ratio:.1%} of the services")
+
+
+def create_synthetic_classification_data(number_of_rows, number_of_metrics, number_of_services):
+    rng = np.random.default_rng(0)
+    features = rng.integers(0, 3, (number_of_rows, number_of_metrics))
+    fault_codes = features[:, :5].sum(axis=1) * 3 + rng.integers(0, 5, number_of_rows)
+    labels = np.array([f"edgex_service_{code % number_of_services}_{code % 4 + 1}"
+                       if code < number_of_services * 4 else "no_fault" for code in fault_codes])
+    return features, labels
+
+
+def predict_with_estimator(classifier, data):
+    return classifier.predict([data])[0], classifier.predict_proba([data])[0]
+
+
+def benchmark_single_row_prediction(repeat):
+    number_of_rows, number_of_metrics, number_of_services = PREDICTION_SHAPE
+    features, labels = create_synthetic_classification_data(number_of_rows, number_of_metrics, number_of_services)
+    random_forest = RandomForestClassifier(n_estimators=100, random_state=42).fit(features, labels)
+    svm = SVC(kernel="linear", random_state=42, probability=True).fit(features[:PREDICTION_SVM_ROWS],
+                                                                     labels[:PREDICTION_SVM_ROWS])
+    test_rows = np.random.default_rng(1).integers(0, 3, (repeat, number_of_metrics))
+    for name, classifier, predictor in [("Random forest", random_forest, CompiledRandomForest(random_forest)),
+                                        ("SVM", svm, CompiledSVM(svm))]:
+        identical = all(prediction == compiled_prediction and np.array_equal(proba, compiled_proba)
+                        for (prediction, proba), (compiled_prediction, compiled_proba) in
+                        ((predict_with_estimator(classifier, row), predictor.predict(row)) for row in test_rows))
+        estimator_duration = measure(lambda: [predict_with_estimator(classifier, row) for row in test_rows],
+                                     repeat=1) / len(test_rows)
+        compiled_duration = measure(lambda: [predictor.predict(row) for row in test_rows], repeat=1) / len(test_rows)
+        logger.info(f"{name} single row prediction: {estimator_duration * 1e6:.1f} us with the estimator, "
+                    f"{compiled_duration * 1e6:.1f} us compiled, identical results: {identical}")
+
+
+BENCHMARKS = {
+    "step_parsing": benchmark_step_parsing,
+    "preprocessing": benchmark_preprocessing,
+    "cbn_structure_learning": benchmark_cbn_structure_learning,
+    "approximate_inference": benchmark_approximate_inference,
+    "single_row_prediction": benchmark_single_row_prediction,
+}
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=getattr(logging, c.LOG_LEVEL),
+                        format=c.LOGGING_FORMAT, datefmt=c.TIME_FORMAT)
+    for benchmark_name, benchmark_method in BENCHMARKS.items():
+        if args.benchmark in ('all', benchmark_name):
+            benchmark_method(args.repeat)
@@ -11,32 +11,33 @@ removed_columns = set()
 INSIGNIFICANCE_THRESHOLD = 0.98
 RELIABILITY_THRESHOLD = 0.7
 AVAILABILITY_THRESHOLD = 0.3
+FAULT_STATUS = {"delay": 1, "cpu": 2, "memory": 3, "failure": 4}
 
 
 def make_service_columns_binary(training_data):
-    services = []
-    new_columns = []
-    for column_name in training_data.columns:
-        if column_name.startswith("edgex"):
-            services.append(column_name)
-            new_columns.extend(
-                [f"{column_name}_delay", f"{column_name}_cpu", f"{column_name}_memory", f"{column_name}_failure"])
-    for new_column in new_columns:
-        training_data[new_column] = 0
+    services = [column_name for column_name in training_data.columns if column_name.startswith("edgex")]
     for service_name in services:
-        for index, value in training_data[service_name].items():
-            if value == 1:
-                training_data.loc[index, f"{service_name}_delay"] = 1
-            elif value == 2:
-                training_data.loc[index, f"{service_name}_cpu"] = 1
-            elif value == 3:
-                training_data.loc[index, f"{service_name}_memory"] = 1
-            elif value == 4:
-                training_data.loc[index, f"{service_name}_failure"] = 1
+        for fault_type, fault_status in FAULT_STATUS.items():
+            training_data[f"{service_name}_{fault_type}"] = (training_data[service_name] == fault_status).astype(int)
     training_data = training_data.drop(columns=services)
     return training_data
 
 
+def expand_samples_by_fault(training_dataframe, service_statuses):
+    # Callers pass a set, sorting keeps the expanded rows independent of the hash seed
+    service_statuses = sorted(service_statuses)
+    fault_statuses = training_dataframe[service_statuses].to_numpy()
+    faulty = fault_statuses != 0
+    number_of_faults = faulty.sum(axis=1)
+    # A row is repeated once per concurrent fault with its own label, rows without any fault are kept once as no_fault
+    labels = np.column_stack([np.char.add(np.char.add(service_statuses, '_'), fault_statuses.astype(str)),
+                              np.full(faulty.shape[0], 'no_fault')])
+    Y = labels[np.column_stack([faulty, number_of_faults == 0])]
+    X = training_dataframe.drop(columns=service_statuses)
+    X = X.iloc[np.repeat(np.arange(X.shape[0]), np.maximum(number_of_faults, 1))].reset_index(drop=True)
+    return X, Y
+
+
 def remove_columns_with_single_value(given_dataframe):
     columns_to_remove = []
     for column in given_dataframe.columns.copy():
@@ -109,42 +110,35 @@ def remove_columns_unavailable_on_training_data(given_data, training_data):
 
 
 def filter_data(config, given_dataframe):
-    rows_to_remove = []
-    columns_to_remove = []
+    rows_to_remove = np.zeros(given_dataframe.shape[0], dtype=bool)
     for service_name in config["services_skipped"]:
         if service_name not in given_dataframe:
             continue
-        for index, value in given_dataframe[service_name].items():
-            if value != 0:
-                rows_to_remove.append(index)
-                logger.info(f"Row {index} is related to {service_name}")
+        related_rows = (given_dataframe[service_name] != 0).to_numpy()
+        if related_rows.any():
+            logger.info(f"Rows {list(given_dataframe.index[related_rows])} are related to {service_name}")
+        rows_to_remove |= related_rows
+    fault_injected_services = [service_name for service_name in config["services_for_fault_injection"]
+                               if service_name in given_dataframe]
     for experiment_type, experiment_status in config["experiments_skipped"].items():
-        for service_name in config["services_for_fault_injection"]:
-            if service_name not in given_dataframe:
-                continue
-            for index, value in given_dataframe[service_name].items():
-                if value == experiment_status:
-                    rows_to_remove.append(index)
-                    logger.debug(f"Row {index} is related to experiment type {experiment_type} for {service_name}")
-
-    logger.debug(f"These rows are gonna be removed: {rows_to_remove}")
-    rows_to_remove = set(rows_to_remove)
-    if rows_to_remove:
+        related_rows = given_dataframe[fault_injected_services].isin([experiment_status]).any(axis=1).to_numpy()
+        if related_rows.any():
+            logger.debug(f"Rows {list(given_dataframe.index[related_rows])} are related to experiment type "
+                         f"{experiment_type}")
+        rows_to_remove |= related_rows
+
+    rows_to_remove = given_dataframe.index[rows_to_remove]
+    logger.debug(f"These rows are gonna be removed: {list(rows_to_remove)}")
+    if not rows_to_remove.empty:
         given_dataframe.drop(rows_to_remove, inplace=True)
         given_dataframe.reset_index(inplace=True, drop=True)
-    for column in given_dataframe.columns:
-        for metric_name in config["metrics_skipped"]:
-            if column.startswith(metric_name):
-                columns_to_remove.append(column)
-                continue
-        for service_name in config["services_skipped"]:
-            if service_name in column:
-                columns_to_remove.append(column)
-                break
-        if "istio_init" in column:
-            columns_to_remove.append(column)
-    if columns_to_remove:
-        columns_to_remove = set(columns_to_remove)
+    columns = given_dataframe.columns
+    columns_to_remove = columns.str.startswith(tuple(config["metrics_skipped"])) | \
+        columns.str.contains("istio_init", regex=False)
+    for service_name in config["services_skipped"]:
+        columns_to_remove |= columns.str.contains(service_name, regex=False)
+    if columns_to_remove.any():
+        columns_to_remove = set(columns[columns_to_remove])
         given_dataframe = given_dataframe.drop(columns=columns_to_remove)
         logger.info(f"These columns are removed because of skip configurations: {columns_to_remove}")
         removed_columns.update(columns_to_remove)
@@ -152,25 +146,23 @@ def filter_data(config, given_dataframe):
 
 
 def remove_majorly_empty_columns(all_dataframe, ground_truth_data_size=30):
-    mean_ground_truth_values = {}
-    for column in all_dataframe.columns.copy():
-        number_of_empty_rows_in_ground_truth = all_dataframe.head(ground_truth_data_size)[column].isna().sum()
-        number_of_empty_rows_totally = all_dataframe[column].isna().sum()
-        if number_of_empty_rows_in_ground_truth > ground_truth_data_size * (1 - AVAILABILITY_THRESHOLD):
-            logger.info(
-                f"Removing {column} since it has {number_of_empty_rows_in_ground_truth} empty results in ground truth "
-                f"and {number_of_empty_rows_totally} in overall")
-            removed_columns.add(column)
-            all_dataframe.pop(column)
-            continue
-        if column == "timestamp":
-            continue
-        column_mean_value = all_dataframe.head(ground_truth_data_size)[column].mean()
-        mean_ground_truth_values[column] = column_mean_value
-        num_of_empty_cells = all_dataframe[column].isna().sum()
-        if num_of_empty_cells != 0:
-            logger.info(f"Filling {num_of_empty_cells} cells of column {column} with {column_mean_value}")
-        all_dataframe[column].fillna(column_mean_value, inplace=True)
+    ground_truth_dataframe = all_dataframe.head(ground_truth_data_size)
+    empty_rows_in_ground_truth = ground_truth_dataframe.isna().sum()
+    empty_rows_totally = all_dataframe.isna().sum()
+    majorly_empty_columns = empty_rows_in_ground_truth.index[
+        empty_rows_in_ground_truth > ground_truth_data_size * (1 - AVAILABILITY_THRESHOLD)]
+    for column in majorly_empty_columns:
+        logger.info(
+            f"Removing {column} since it has {empty_rows_in_ground_truth[column]} empty results in ground truth "
+            f"and {empty_rows_totally[column]} in overall")
+    removed_columns.update(majorly_empty_columns)
+    all_dataframe.drop(columns=majorly_empty_columns, inplace=True)
+    metric_columns = all_dataframe.columns.drop("timestamp", errors="ignore")
+    mean_ground_truth_values = {column: ground_truth_dataframe[column].mean() for column in metric_columns}
+    for column in metric_columns[empty_rows_totally[metric_columns].to_numpy() != 0]:
+        logger.info(f"Filling {empty_rows_totally[column]} cells of column {column} with "
+                    f"{mean_ground_truth_values[column]}")
+    all_dataframe.fillna(mean_ground_truth_values, inplace=True)
     return all_dataframe, mean_ground_truth_values
 
 
@@ -204,3 +196,40 @@ def filter_and_fill_with_ground_truth_data(given_dataframe, mean_ground_truth_va
     last_metrics["timestamp"] = last_metrics["timestamp"].strftime('%Y-%m-%d %H:%M:%S')
 
     return last_metrics
+
+
+class FeatureSchema:
+
+    def __init__(self, training_data, mean_ground_truth_values):
+        self.features = [column for column in training_data.columns if not column.startswith("edgex")]
+        self.feature_indices = {feature: index for index, feature in enumerate(self.features)}
+        self.default_values = np.array([mean_ground_truth_values.get(feature, np.NaN) for feature in self.features],
+                                       dtype=float)
+        self.row_index = pd.Index(["timestamp", *self.features])
+        self.projections = {}
+
+    def get_projection(self, columns):
+        # The collected columns rarely change between steps, so the gather indices are built once per column layout
+        columns = tuple(columns)
+        if columns not in self.projections:
+            source_positions = []
+            feature_positions = []
+            dropped_columns = []
+            for position, column in enumerate(columns):
+                feature_position = self.feature_indices.get(column.replace('-', '_'))
+                if feature_position is not None:
+                    source_positions.append(position)
+                    feature_positions.append(feature_position)
+                elif column != "timestamp" and not column.startswith("edgex"):
+                    dropped_columns.append(column)
+            logger.info(f"These columns will be removed since they are unavailable on training data: {dropped_columns}")
+            self.projections[columns] = (source_positions, np.array(feature_positions, dtype=int))
+        return self.projections[columns]
+
+    def project(self, given_dataframe):
+        source_positions, feature_positions = self.get_projection(given_dataframe.columns)
+        values = self.default_values.copy()
+        collected_values = given_dataframe.to_numpy()[-1, source_positions].astype(float)
+        is_collected = ~np.isnan(collected_values)
+        values[feature_positions[is_collected]] = collected_values[is_collected]
+        return pd.Series([given_dataframe["timestamp"].iloc[-1], *values], index=self.row_index)
@@ -0,0 +1,92 @@
+import logging
+import os
+from os import path
+
+import pyarrow as pa
+
+ARROW_FILE_EXTENSION = ".arrow"
+# Arrow IPC files start with "ARROW1" padded to 8 bytes, the stream format follows
+ARROW_FILE_MAGIC_LENGTH = 8
+RESUME_FILE_SUFFIX = ".resume"
+logger = logging.getLogger(__name__)
+
+
+def get_schema(dataframe):
+    return pa.Schema.from_pandas(dataframe, preserve_index=False)
+
+
+def read_unfinished_arrow_file(source, filename):
+    # The footer is only written when the file is closed, so a running or crashed collection leaves a plain stream
+    source.seek(ARROW_FILE_MAGIC_LENGTH)
+    reader = pa.ipc.open_stream(source)
+    batches = []
+    try:
+        for batch in reader:
+            batches.append(batch)
+    except (pa.ArrowInvalid, OSError):
+        logger.warning(f"Ignoring the incomplete record batch at the end of {filename}")
+    return pa.Table.from_batches(batches, schema=reader.schema)
+
+
+def read_arrow_table(filename):
+    source = pa.memory_map(filename, "r")
+    try:
+        return pa.ipc.open_file(source).read_all()
+    except pa.ArrowInvalid:
+        return read_unfinished_arrow_file(source, filename)
+
+
+def read_dataset(filename):
+    return read_arrow_table(filename).to_pandas()
+
+
+def count_rows(filename):
+    return read_arrow_table(filename).num_rows
+
+
+def write_dataset(filename, dataframe):
+    dataset_writer = ArrowDatasetWriter(filename, get_schema(dataframe))
+    dataset_writer.append(dataframe)
+    dataset_writer.close()
+
+
+class ArrowDatasetWriter:
+
+    def __init__(self, filename, schema=None):
+        self.filename = filename
+        self.number_of_rows = 0
+        resume_filename = filename + RESUME_FILE_SUFFIX
+        if path.exists(filename) and not path.exists(resume_filename):
+            os.replace(filename, resume_filename)
+        existing_table = None
+        if path.exists(resume_filename):
+            existing_table = read_arrow_table(resume_filename)
+            schema = existing_table.schema
+            logger.info(f"Resuming {filename} after {existing_table.num_rows} rows")
+        self.schema = schema
+        self.integer_defaults = {field.name: 0 for field in schema if pa.types.is_integer(field.type)}
+        self.sink = pa.OSFile(filename, "wb")
+        self.writer = pa.ipc.new_file(self.sink, schema)
+        if existing_table is not None:
+            self.writer.write_table(existing_table)
+            self.sink.flush()
+            self.number_of_rows = existing_table.num_rows
+            os.remove(resume_filename)
+
+    def conform(self, dataframe):
+        unknown_columns = set(dataframe.columns) - set(self.schema.names)
+        if unknown_columns:
+            logger.debug(f"These columns are skipped since they are not in the dataset schema: {unknown_columns}")
+        dataframe = dataframe.reindex(columns=self.schema.names)
+        return dataframe.fillna(self.integer_defaults)
+
+    def append(self, dataframe):
+        dataframe = self.conform(dataframe)
+        self.writer.write_batch(pa.RecordBatch.from_pandas(dataframe, schema=self.schema, preserve_index=False))
+        self.sink.flush()
+        self.number_of_rows += dataframe.shape[0]
+        return dataframe
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
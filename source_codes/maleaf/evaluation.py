@@ -1,12 +1,16 @@
+import copy
 import glob
 import logging
 import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import yaml
 
 import config as c
 import main
-from generate_model import train_model
+from generate_model import get_dataset_tag
+from test_data import get_record_filename, is_test_completed
 
 TRAINING_DATASET_START_INDEX = 0
 TEST_DATASET_START_INDEX = 1
@@ -14,49 +18,100 @@ NUMBER_OF_DATASETS_FOR_TRAINING = 1
 TRAINING_DATASET_FOLDER = "dataset"
 TEST_DATASET_FOLDER = "dataset"
 MAX_NUMBER_OF_SERVICES = 8
+# Worker counts of the pools started inside a pair, they are set to 1 when pairs are evaluated in parallel
+INNER_WORKER_KEYS = ["discretization_workers", "cbn_fitting_workers", "rca_workers"]
 logger = logging.getLogger(__name__)
-original_set_of_services_for_fault_injection = []
-original_services_skipped = []
-shapes=[]
 
-def loop_datasets():
+
+def get_dataset_pairs():
     list_of_training_datasets = list(glob.iglob(f'{TRAINING_DATASET_FOLDER}/*.csv'))
     list_of_training_datasets = sorted(list_of_training_datasets)
     list_of_test_datasets = list(glob.iglob(f'{TEST_DATASET_FOLDER}/*.csv'))
     list_of_test_datasets = sorted(list_of_test_datasets)
-    original_set_of_services_for_fault_injection.extend(app_config["services_for_fault_injection"])
-    original_services_skipped.extend(app_config["services_skipped"])
+    dataset_pairs = []
     for file_index in range(len(list_of_training_datasets)):
         if file_index < TRAINING_DATASET_START_INDEX:
             continue
-        app_config["training_data"] = list_of_training_datasets[file_index:file_index + NUMBER_OF_DATASETS_FOR_TRAINING]
-        if len(app_config["training_data"]) < NUMBER_OF_DATASETS_FOR_TRAINING:
-            app_config["training_data"].extend(
-                list_of_training_datasets[:NUMBER_OF_DATASETS_FOR_TRAINING - len(app_config["training_data"])])
-        app_config["test_data"] = [
-            list_of_test_datasets[(file_index + TEST_DATASET_START_INDEX) % len(list_of_test_datasets)]]
-        logger.info(f"\nTraining files:\t{app_config['training_data']}\nTest files:\t{app_config['test_data']}")
-        if len(original_set_of_services_for_fault_injection) >= MAX_NUMBER_OF_SERVICES:
-            services_for_fault_injection = random.sample(original_set_of_services_for_fault_injection,
-                                                         MAX_NUMBER_OF_SERVICES)
-            skipped_services = set(original_set_of_services_for_fault_injection) - set(services_for_fault_injection)
-            skipped_services.update(original_services_skipped)
-            app_config["services_for_fault_injection"] = services_for_fault_injection
-            app_config["services_skipped"] = list(skipped_services)
-        logger.info(f"Services for fault injection: {app_config['services_for_fault_injection']}")
-        logger.info(f"Skipped services: {app_config['services_skipped']}")
-        try:
-            pass
-            main.run(app_config)
-            #training_data_shape = train_model(app_config)
-            #shapes.append(training_data_shape[1])
-        except Exception as e:
-            logger.exception(f"Error occurred for datasets '{app_config['training_data']}':\n{e}")
-    logger.info(f"\n{shapes}")
+        training_data = list_of_training_datasets[file_index:file_index + NUMBER_OF_DATASETS_FOR_TRAINING]
+        if len(training_data) < NUMBER_OF_DATASETS_FOR_TRAINING:
+            training_data.extend(list_of_training_datasets[:NUMBER_OF_DATASETS_FOR_TRAINING - len(training_data)])
+        test_data = [list_of_test_datasets[(file_index + TEST_DATASET_START_INDEX) % len(list_of_test_datasets)]]
+        dataset_pairs.append((training_data, test_data))
+    return dataset_pairs
+
+
+def create_pair_config(app_config, training_data, test_data):
+    # Each pair gets its own copy, so the sampled services of one pair never leak into the next one
+    pair_config = copy.deepcopy(app_config)
+    pair_config["training_data"] = training_data
+    pair_config["test_data"] = test_data
+    if len(app_config["services_for_fault_injection"]) >= MAX_NUMBER_OF_SERVICES:
+        services_for_fault_injection = random.sample(app_config["services_for_fault_injection"],
+                                                     MAX_NUMBER_OF_SERVICES)
+        skipped_services = set(app_config["services_for_fault_injection"]) - set(services_for_fault_injection)
+        skipped_services.update(app_config["services_skipped"])
+        pair_config["services_for_fault_injection"] = services_for_fault_injection
+        pair_config["services_skipped"] = list(skipped_services)
+    if get_evaluation_workers(app_config) > 1:
+        # Parallel pairs already use every core, more processes inside each pair would only oversubscribe them
+        pair_config.update({key: 1 for key in INNER_WORKER_KEYS})
+    return pair_config
+
+
+def get_evaluation_workers(app_config):
+    return app_config.get("evaluation_workers", 1)
+
+
+def is_pair_completed(pair_config):
+    rca_algorithms = pair_config.get("rca_algorithms") or [pair_config["rca_algorithm"]]
+    training_dataset_tag = get_dataset_tag(pair_config["training_data"])
+    test_dataset_tag = get_dataset_tag(pair_config["test_data"])
+    return all(is_test_completed(get_record_filename({**pair_config, "rca_algorithm": rca_algorithm},
+                                                     test_dataset_tag, training_dataset_tag))
+               for rca_algorithm in rca_algorithms)
+
+
+def evaluate_pair(pair_config):
+    start_time = time.time()
+    logger.info(f"\nTraining files:\t{pair_config['training_data']}\nTest files:\t{pair_config['test_data']}")
+    logger.info(f"Services for fault injection: {pair_config['services_for_fault_injection']}")
+    logger.info(f"Skipped services: {pair_config['services_skipped']}")
+    main.run(pair_config)
+    return time.time() - start_time
+
+
+def evaluate_pair_in_new_process(pair_config):
+    # Every pair gets a fresh process, so module globals such as the removed columns never leak into the next pair
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(evaluate_pair, pair_config).result()
+
+
+def loop_datasets(app_config):
+    pair_configs = [create_pair_config(app_config, training_data, test_data)
+                    for training_data, test_data in get_dataset_pairs()]
+    pending_pair_configs = [pair_config for pair_config in pair_configs if not is_pair_completed(pair_config)]
+    logger.info(f"Evaluating {len(pending_pair_configs)} of {len(pair_configs)} dataset pairs, "
+                f"the others have finished result files")
+    start_time = time.time()
+    wall_times = {}
+    with ThreadPoolExecutor(max_workers=get_evaluation_workers(app_config)) as executor:
+        futures = {executor.submit(evaluate_pair_in_new_process, pair_config): pair_config
+                   for pair_config in pending_pair_configs}
+        for future in as_completed(futures):
+            pair_config = futures[future]
+            try:
+                wall_times[get_dataset_tag(pair_config["training_data"])] = future.result()
+                logger.info(f"Finished {len(wall_times)}/{len(pending_pair_configs)} dataset pairs, "
+                            f"{pair_config['training_data']} in {future.result():.2f} seconds")
+            except Exception as e:
+                logger.exception(f"Error occurred for datasets '{pair_config['training_data']}':\n{e}")
+    logger.info(f"Evaluated {len(wall_times)} dataset pairs in {time.time() - start_time:.2f} seconds")
+    return wall_times
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=getattr(logging, c.LOG_LEVEL),
                         format=c.LOGGING_FORMAT, datefmt=c.TIME_FORMAT)
     with open('config.yaml') as f:
         app_config = yaml.load(f, Loader=yaml.FullLoader)
-    loop_datasets()
+    loop_datasets(app_config)
@@ -4,12 +4,16 @@ import logging
 import math
 import re
 
+import numpy as np
 import pandas as pd
 import yaml
 
-from anomaly_detection import discretize
+from anomaly_detection import discretize, compile_threshold_tables, get_normal_states, DISCRETIZATION_RANDOM_STATE
+from dataset_storage import read_dataset, ARROW_FILE_EXTENSION
 from data_manipulation import remove_columns_with_single_value, filter_data, \
-    remove_majorly_empty_columns, remove_columns_with_small_effect, remove_columns_with_unstable_output
+    remove_majorly_empty_columns, remove_columns_with_small_effect, remove_columns_with_unstable_output, \
+    FeatureSchema, removed_columns
+from model_cache import get_model_cache
 from models.trained_model_cbn import TrainedModelCBN
 from models.trained_model_svm import TrainedModelSVM
 from models.trained_model_random_forest import TrainedModelRandomForest
@@ -70,29 +74,42 @@ def discretize_data(training_data, birch_instances):
 
 def clustering_based_anomaly_detection(training_dataframe):
     anomaly_states_by_metric, birch_instances, sort_indices, normalization_factors = discretize(training_dataframe)
-    for metric, states in anomaly_states_by_metric.items():
-        for step_no, state in enumerate(states):
-            training_dataframe.loc[step_no, metric] = state
-    return training_dataframe.astype("int32")
+    return replace_metrics_with_states(training_dataframe, anomaly_states_by_metric)
+
+
+def replace_metrics_with_states(training_dataframe, anomaly_states_by_metric):
+    # The whole frame is written into one int32 block, which the DataFrame then wraps without copying
+    columns = training_dataframe.columns
+    metric_positions = columns.get_indexer(list(anomaly_states_by_metric))
+    other_positions = np.setdiff1d(np.arange(columns.size), metric_positions)
+    discrete_data = np.empty(training_dataframe.shape, dtype=np.int32)
+    if anomaly_states_by_metric:
+        discrete_data[:, metric_positions] = np.column_stack(list(anomaly_states_by_metric.values()))
+    discrete_data[:, other_positions] = training_dataframe.iloc[:, other_positions].astype("int32").to_numpy()
+    return pd.DataFrame(discrete_data, index=training_dataframe.index, columns=columns)
+
+
+def read_training_data_file(file_name):
+    if file_name.endswith(ARROW_FILE_EXTENSION):
+        return read_dataset(file_name)
+    # First column of the csv files is the index of the collection
+    return pd.read_csv(file_name).iloc[:, 1:]
 
 
 def get_training_data(training_data_files):
-    training_dataframe = pd.DataFrame()
-    for file_name in training_data_files:
-        single_file_training_dataframe = pd.read_csv(file_name)
-        training_dataframe = pd.concat([training_dataframe, single_file_training_dataframe], ignore_index=True)
-    training_dataframe = training_dataframe.iloc[:, 1:]
+    training_dataframe = pd.concat([read_training_data_file(file_name) for file_name in training_data_files],
+                                   ignore_index=True)
     # training_dataframe = training_dataframe.fillna(0)
     return training_dataframe
 
 
 def get_latest_simulation_file(folder_path="dataset"):
-    list_of_csv_files = glob.glob(f'{folder_path}/*.csv')
-    return max(list_of_csv_files)
+    list_of_dataset_files = glob.glob(f'{folder_path}/training_data_*.csv') + \
+                            glob.glob(f'{folder_path}/training_data_*{ARROW_FILE_EXTENSION}')
+    return max(list_of_dataset_files)
 
 
-def train_model(config):
-    training_data, dataset_tag = get_raw_data(config)
+def preprocess_training_data(config, training_data):
     training_data = filter_data(config, training_data)
     training_data.pop("timestamp")
     training_data.columns = training_data.columns.str.replace('-', '_')
@@ -100,38 +117,73 @@ def train_model(config):
         "number_of_initial_steps"])
     training_data = remove_columns_with_single_value(training_data)
     anomaly_states_by_metric, clustering_instances, sort_indices, normalization_factors = \
-        discretize(training_data, base_data_size=config["number_of_initial_steps"])
+        discretize(training_data, base_data_size=config["number_of_initial_steps"],
+                   n_workers=config.get("discretization_workers", 1),
+                   random_state=config.get("random_state_discretization", DISCRETIZATION_RANDOM_STATE))
+    threshold_tables = compile_threshold_tables(clustering_instances, sort_indices, normalization_factors)
     remove_columns_with_small_effect(training_data, anomaly_states_by_metric)
     remove_columns_with_unstable_output(training_data, anomaly_states_by_metric, config["number_of_initial_steps"])
 
-    for metric, states in anomaly_states_by_metric.items():
-        for step_no, state in enumerate(states):
-            training_data.loc[step_no, metric] = state
-    training_data = training_data.astype('int32')
+    training_data = replace_metrics_with_states(training_data, anomaly_states_by_metric)
     training_data = remove_columns_with_single_value(training_data)
+    normal_states = get_normal_states(training_data, config["number_of_initial_steps"])
+    feature_schema = FeatureSchema(training_data, mean_ground_truth_values)
+    return training_data, threshold_tables, normal_states, feature_schema, mean_ground_truth_values
+
+
+def get_preprocessed_training_data(config):
+    raw_training_data, dataset_tag = get_raw_data(config)
+    # Discretization dominates the training time, so its output is shared by every model trained on the same data
+    model_cache = get_model_cache(config)
+    cache_key = model_cache.get_key(config, "preprocessing", raw_training_data)
+    cached_data = model_cache.read(cache_key)
+    if cached_data is not None:
+        preprocessed_data, preprocessing_removed_columns = cached_data
+    else:
+        # The columns removed by the filters are kept with the data, so a cache hit leaves the same removed columns
+        previously_removed_columns = set(removed_columns)
+        removed_columns.clear()
+        preprocessed_data = preprocess_training_data(config, raw_training_data)
+        preprocessing_removed_columns = set(removed_columns)
+        model_cache.write(cache_key, (preprocessed_data, preprocessing_removed_columns))
+        model_cache.add(cache_key, "preprocessing", dataset_tag)
+        removed_columns.update(previously_removed_columns)
+    removed_columns.update(preprocessing_removed_columns)
+    return preprocessed_data, dataset_tag
+
+
+def train_model(config, preprocessed_training_data=None):
+    if preprocessed_training_data is None:
+        preprocessed_training_data = get_preprocessed_training_data(config)
+    (training_data, threshold_tables, normal_states, feature_schema, mean_ground_truth_values), dataset_tag = \
+        preprocessed_training_data
 
     rca_algorithm = config['rca_algorithm']
     trained_model = None
     if rca_algorithm == 'svm':
-        trained_model = TrainedModelSVM(config=config, clustering_instances=clustering_instances,
-                                        sort_indices=sort_indices,
-                                        normalization_factors=normalization_factors, training_data=training_data,
+        trained_model = TrainedModelSVM(config=config, threshold_tables=threshold_tables, normal_states=normal_states,
+                                        feature_schema=feature_schema, training_data=training_data,
                                         mean_ground_truth_values=mean_ground_truth_values, dataset_tag=dataset_tag)
     elif rca_algorithm == 'random_forest':
-        trained_model = TrainedModelRandomForest(config=config, clustering_instances=clustering_instances,
-                                        sort_indices=sort_indices,
-                                        normalization_factors=normalization_factors, training_data=training_data,
-                                        mean_ground_truth_values=mean_ground_truth_values, dataset_tag=dataset_tag)
+        trained_model = TrainedModelRandomForest(config=config, threshold_tables=threshold_tables,
+                                                 normal_states=normal_states, feature_schema=feature_schema,
+                                                 training_data=training_data,
+                                                 mean_ground_truth_values=mean_ground_truth_values,
+                                                 dataset_tag=dataset_tag)
     elif rca_algorithm == 'cbn':
         logger.info(f"Shape of data: {training_data.shape}")
-        trained_model = TrainedModelCBN(config=config, clustering_instances=clustering_instances, sort_indices=sort_indices,
-                                        normalization_factors=normalization_factors, training_data=training_data,
+        trained_model = TrainedModelCBN(config=config, threshold_tables=threshold_tables, normal_states=normal_states,
+                                        feature_schema=feature_schema, training_data=training_data,
                                         mean_ground_truth_values=mean_ground_truth_values, dataset_tag=dataset_tag)
     else:
         logger.error('rca algorithm not specified')
     return trained_model
 
 
+def get_dataset_tag(data_files):
+    return "_".join([re.sub(r'[^\w\d-]', '_', file_path) for file_path in data_files])
+
+
 def get_raw_data(config, is_test_data=False):
     if is_test_data:
         training_data_files = config["test_data"]
@@ -151,7 +203,7 @@ def get_raw_data(config, is_test_data=False):
                 ignore_index=True)
     else:
         sliced_dataframe = retrieved_dataframe.head(number_of_rows)
-    dataset_tag = "_".join([re.sub(r'[^\w\d-]', '_', file_path) for file_path in training_data_files])
+    dataset_tag = get_dataset_tag(training_data_files)
     logger.info(f"Dataset tag is {dataset_tag} for {'test' if is_test_data else 'training'}")
     return sliced_dataframe, dataset_tag
 
@@ -18,6 +18,7 @@ PRECISION_LEVELS = [1, 2, 3, 4]
 SKIPPED_DATASETS = []
 
 RESULT_FOLDERS = ["results"]
+RESULT_FILE_EXTENSION = ".jsonl"
 
 logger = logging.getLogger(__name__)
 DECISION_THRESHOLD = 0.184
@@ -41,6 +42,28 @@ def read_json_from_file(filename):
         return json.load(outfile)
 
 
+def read_json_lines(filename):
+    with open(filename, "r") as record_file:
+        for line in record_file:
+            yield json.loads(line)
+
+
+def read_result_records(file_path):
+    # The header with the training completion time comes first, then one record per test step
+    if not file_path.endswith(RESULT_FILE_EXTENSION):
+        # Result files written before the switch to JSON lines hold the whole document
+        data_set_results = read_json_from_file(file_path)
+        yield {"training_completion_time": data_set_results["training_completion_time"]}
+        yield from data_set_results["test_results"]
+        return
+    try:
+        for record in read_json_lines(file_path):
+            if not record.get("completed"):
+                yield record
+    except ValueError:
+        logger.warning(f"Ignoring the incomplete last line of {file_path}")
+
+
 def check_dataset_skipped(file_path):
     for skipped_dataset in SKIPPED_DATASETS:
         if skipped_dataset in file_path:
@@ -48,24 +71,36 @@ def check_dataset_skipped(file_path):
 
 
 def get_results():
-    all_results = []
+    # The files are read lazily, a dataset is only parsed while its test results are consumed
     for result_folder in RESULT_FOLDERS:
         list_of_files = glob.glob(result_folder + "/*")
         for file_path in list_of_files:
-            data_set_results = read_json_from_file(file_path)
-            if len(data_set_results['test_results']) < 48:
-                logger.info(f"Number of incidents in this file {file_path}: {len(data_set_results['test_results'])}")
             if check_dataset_skipped(file_path):
                 logger.info(f"Skipping this dataset: {file_path}")
                 continue
-            all_results.append(data_set_results)
-    return all_results
+            records = read_result_records(file_path)
+            header = next(records, None)
+            if header is None:
+                logger.warning(f"Skipping the empty result file {file_path}")
+                continue
+            yield file_path, header["training_completion_time"], records
 
 
-def get_training_time(all_results):
+def get_training_times_and_incidents(dataset_results):
     training_completion_times = []
-    for dataset_result in all_results:
-        training_completion_times.append(dataset_result['training_completion_time'])
+    incidents = []
+    for file_path, training_completion_time, test_results in dataset_results:
+        training_completion_times.append(training_completion_time)
+        number_of_previous_incidents = len(incidents)
+        incidents.extend(test_results)
+        if len(incidents) - number_of_previous_incidents < 48:
+            logger.info(f"Number of incidents in this file {file_path}: "
+                        f"{len(incidents) - number_of_previous_incidents}")
+    logger.info(f"Total number of incidents: {len(incidents)}")
+    return training_completion_times, incidents
+
+
+def get_training_time(training_completion_times):
     logger.info(f"Training times: {training_completion_times}")
     pd.DataFrame(training_completion_times).to_csv(f'kpi/training_times_{RESULT_FILES_SUFFIX}.csv', header=None, index=False)
     logger.info(f"Average training time: {mean(training_completion_times):.2f} seconds with "
@@ -302,14 +337,6 @@ def get_kpis(incidents, decision_threshold=DECISION_THRESHOLD):
             "inverse_of_rank": inverse_of_rank_score}
 
 
-def get_incidents(dataset_results):
-    incidents = []
-    for dataset_result in dataset_results:
-        incidents.extend(dataset_result['test_results'])
-    logger.info(f"Total number of incidents: {len(incidents)}")
-    return incidents
-
-
 def add_no_incidents(incidents, no_incident_cases):
     if len(incidents) < len(no_incident_cases):
         no_incident_cases_to_add = random.sample(no_incident_cases, len(incidents))
@@ -421,9 +448,8 @@ def save_data_to_file(data, filename):
 if __name__ == '__main__':
     logging.basicConfig(level=getattr(logging, c.LOG_LEVEL),
                         format=c.LOGGING_FORMAT, datefmt=c.TIME_FORMAT)
-    all_dataset_results = get_results()
-    training_times = get_training_time(all_dataset_results)
-    all_incidents = get_incidents(all_dataset_results)
+    training_completion_times, all_incidents = get_training_times_and_incidents(get_results())
+    training_times = get_training_time(training_completion_times)
     mrr_by_threshold = get_mrr_for_different_threshold_values(all_incidents)
     save_data_to_file(mrr_by_threshold, f"mrr_results/{'_'.join(RESULT_FOLDERS)}_{RESULT_FILES_SUFFIX}")
     accuracy_by_threshold = get_accuracy_for_different_threshold_values(all_incidents)
@@ -1,22 +1,25 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import os
 import pickle
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import yaml
 
 from rca import loop_retrieve_training_step, wait_rest_of_interval_time
-from data_manipulation import remove_previously_deleted_columns, fill_empty_cells_with_ground_truth_data, \
-    remove_columns_unavailable_on_training_data, filter_and_fill_with_ground_truth_data
-from generate_model import train_model
+from data_manipulation import filter_and_fill_with_ground_truth_data
+from generate_model import train_model, get_preprocessed_training_data
 from lasm_utils import send_metrics
 from models.exception import NewMetricFound
-from sla import get_trails, get_service_level_agreements
-from test_data import get_test_data_from_live_system, test_stored_data, check_metrics
+from sla import get_trails, get_service_level_agreements, SLAViolationChecker
+from test_data import get_test_data_from_live_system, test_stored_data, check_metrics, save_json_to_file
 
+TIMING_REPORT_FOLDER = "timing_reports"
 logger = logging.getLogger(__name__)
 sla_data = {}
+sla_checker = None
 is_initialization_required = True
 
 
@@ -36,8 +39,50 @@ def read_from_file(file_name="sm.pickle"):
         return pickle.load(sm_file)
 
 
-def run(config):
+def train_and_test_model(config, preprocessed_training_data, preprocessing_time, sla_data):
+    start_time = time.time()
+    trained_model = train_model(config, preprocessed_training_data)
+    training_end_time = time.time()
+    training_completion_time = preprocessing_time + training_end_time - start_time
+    logger.info(f"Training of {config['rca_algorithm']} model completed in {training_completion_time} seconds.")
+    test_stored_data(config, trained_model, training_completion_time=training_completion_time,
+                     training_dataset_tag=trained_model.dataset_tag,
+                     sla_checker=SLAViolationChecker(sla_data, trained_model.feature_schema.features))
+    return {"training_completion_time": training_completion_time,
+            "fitting_time": training_end_time - start_time,
+            "testing_time": time.time() - training_end_time}
+
+
+def run_multiple_models(config):
     global sla_data
+    start_time = time.time()
+    trails_data = get_trails(config['trails_server_urls'])
+    sla_data = get_service_level_agreements(trails_data)
+    preprocessed_training_data = get_preprocessed_training_data(config)
+    preprocessing_time = time.time() - start_time
+    rca_algorithms = config["rca_algorithms"]
+    # Every algorithm is trained and tested in its own process on the same preprocessed data
+    with ProcessPoolExecutor(max_workers=config.get("rca_workers", 1)) as executor:
+        futures = {rca_algorithm: executor.submit(train_and_test_model, {**config, "rca_algorithm": rca_algorithm},
+                                                  preprocessed_training_data, preprocessing_time, sla_data)
+                   for rca_algorithm in rca_algorithms}
+        model_timings = {rca_algorithm: future.result() for rca_algorithm, future in futures.items()}
+    timing_report = {"preprocessing_time": preprocessing_time,
+                     "total_time": time.time() - start_time,
+                     "models": model_timings}
+    timing_report_folder = config.get("timing_report_folder", TIMING_REPORT_FOLDER)
+    os.makedirs(timing_report_folder, exist_ok=True)
+    dataset_tag = preprocessed_training_data[1]
+    save_json_to_file(f"{timing_report_folder}/{dataset_tag}.json", timing_report)
+    logger.info(f"Training and testing of {rca_algorithms} completed in {timing_report['total_time']} seconds.")
+    return timing_report
+
+
+def run(config):
+    global sla_data, sla_checker
+    if config["use_archive"] and config.get("rca_algorithms"):
+        run_multiple_models(config)
+        return
     step_interval = config['step_interval']
     start_time = time.time()
     trained_model = train_model(config)
@@ -45,16 +90,21 @@ def run(config):
     training_completion_time = training_end_time - start_time
     logger.info(f"Training of {config['rca_algorithm']} model completed in {training_completion_time} seconds.")
 
+    last_trails_data = None
     while True:
         step_start_time = time.time()
         try:
             trails_data = get_trails(config['trails_server_urls'])
             logger.debug(trails_data)
-            sla_data = get_service_level_agreements(trails_data)
-            logger.debug(sla_data)
+            if trails_data != last_trails_data:
+                # The SLO checks are compiled again only when the TRAILS document changes
+                sla_data = get_service_level_agreements(trails_data)
+                logger.debug(sla_data)
+                sla_checker = SLAViolationChecker(sla_data, trained_model.feature_schema.features)
+                last_trails_data = trails_data
             if config["use_archive"]:
                 test_stored_data(config, trained_model, training_completion_time=training_completion_time,
-                                 training_dataset_tag=trained_model.dataset_tag, sla_data=sla_data)
+                                 training_dataset_tag=trained_model.dataset_tag, sla_checker=sla_checker)
                 break
             else:
                 new_data = get_test_data_from_live_system(config)
@@ -62,12 +112,8 @@ def run(config):
                 new_step_data = filter_and_fill_with_ground_truth_data(new_data, trained_model.mean_ground_truth_values)
                 send_metrics(new_step_data, config['lasm_server_urls'], config['reporting_identifier'])
 
-                new_data.columns = new_data.columns.str.replace('-', '_')
-                new_data = remove_columns_unavailable_on_training_data(new_data, trained_model.training_data)
-                new_data = new_data.squeeze()
-                new_data = remove_previously_deleted_columns(new_data)
-                fill_empty_cells_with_ground_truth_data(new_data, trained_model.mean_ground_truth_values)
-                check_metrics(config, trained_model, new_data, sla_data=sla_data)
+                new_data = trained_model.feature_schema.project(new_data)
+                check_metrics(config, trained_model, new_data, sla_checker=sla_checker)
         except Exception as e:
             logging.exception(e)
         logging.debug("Checked system")
@@ -78,7 +124,7 @@ def start(configs):
     global is_initialization_required
     while True:
         logging.info('MALEAF is starting...')
-        logging.info('Chosen algorithm: ' + configs['rca_algorithm'])
+        logging.info('Chosen algorithm: ' + str(configs.get('rca_algorithms') or configs['rca_algorithm']))
         try:
             if is_initialization_required:
                 # get_service_graph(configs['prometheus_url'])
@@ -12,6 +12,12 @@ NODE_DICT = {
     '10.0.11.8:10250': 'm2',
     '10.0.11.9:10250': 'm3'
 }
+# Links that do not show up in the Istio traffic metrics
+KNOWN_SERVICE_LINKS = [("edgex-exporter-fledge", "edgex-redis"),
+                       ("edgex-device-rest", "edgex-core-data"),
+                       ("edgex-core-metadata", "edgex-device-rest")]
+SERVICE_METRIC_PREFIXES = ["availability_", "cpu_", "memory_", "error_"]
+SERVICE_GRAPH_FILENAME = 'current_links_mpg.csv'
 logger = logging.getLogger(__name__)
 session = requests.Session()
 
@@ -40,91 +46,120 @@ def prometheus_query(prom_url, query):
     return response.json()['data']['result']
 
 
-def get_response_times(config):
-    prom_url = config['prometheus_url']
-    latency_df = pd.DataFrame()
+def prometheus_range_query(prom_url, query, start_time, end_time, step):
+    response = session.get(prom_url + "/api/v1/query_range",
+                           params={'query': query, 'start': start_time, 'end': end_time, 'step': step}, timeout=30)
+    return response.json()['data']['result']
 
-    # Istio request duration
 
-    query = 'histogram_quantile(0.95, sum(irate(istio_request_duration_milliseconds_bucket{reporter=\"source\", ' \
-            'destination_workload_namespace=\"' + NAMESPACE + \
-            '\"}[' + METRIC_TIME_INTERVAL + '])) by (destination_workload, source_workload, le))'
-    results = prometheus_query(prom_url, query)
-
-    # Add all values to Dataframe
+def get_response_times_query():
+    # Istio request duration
+    return 'histogram_quantile(0.95, sum(irate(istio_request_duration_milliseconds_bucket{reporter=\"source\", ' \
+           'destination_workload_namespace=\"' + NAMESPACE + \
+           '\"}[' + METRIC_TIME_INTERVAL + '])) by (destination_workload, source_workload, le))'
+
+
+def get_latency_metric_name(config, result_metric):
+    dest_svc = result_metric['destination_workload']
+    src_svc = result_metric['source_workload']
+    name = "latency_" + src_svc + '_' + dest_svc
+    if src_svc == 'unknown' or dest_svc == 'unknown':
+        logger.debug("Skipped unknown")
+        return None
+    if src_svc in config["services_skipped"] or dest_svc in config["services_skipped"]:
+        logger.debug(f"Skipped {name}")
+        return None
+    return name
+
+
+def convert_to_latency_values(config, results):
+    latency_values = {}
     for result in results:
         # logger.info(result)
-        dest_svc = result['metric']['destination_workload']
-        src_svc = result['metric']['source_workload']
-        name = "latency_" + src_svc + '_' + dest_svc
-        values = result['value']
-        if src_svc == 'unknown' or dest_svc == 'unknown':
-            logger.debug("Skipped unknown")
-            continue
-        if src_svc in config["services_skipped"] or dest_svc in config["services_skipped"]:
-            logger.debug(f"Skipped {name}")
+        name = get_latency_metric_name(config, result['metric'])
+        if name is None:
             continue
+        values = result['value']
+        if 'timestamp' not in latency_values:
+            latency_values['timestamp'] = values[0]
+        # float() parses Prometheus' "NaN" as well
+        latency_values[name] = float(values[1])
+    return latency_values
 
-        if 'timestamp' not in latency_df:
-            timestamp = values[0]
-            latency_df['timestamp'] = pd.Series(timestamp)
-            latency_df['timestamp'] = latency_df['timestamp'].astype('datetime64[s]')
-        metric = values[1]
-        if metric == "NaN":
-            metric = np.NaN
 
-        latency_df[name] = float(metric)
-        # latency_df[name] = latency_df[name]
-    if 'timestamp' in latency_df:
-        latency_df.set_index('timestamp')
-    return latency_df
+def get_response_times(config):
+    prom_url = config['prometheus_url']
+    query = get_response_times_query()
+    results = prometheus_query(prom_url, query)
+    return convert_to_latency_values(config, results)
 
 
-def get_request_error_rates(config):
-    prom_url = config['prometheus_url']
+def get_request_error_rates_query():
+    return 'sum(irate(istio_requests_total{destination_service_namespace="' + NAMESPACE + \
+           '",response_code!~"200|0|201|207|202"}[' + METRIC_TIME_INTERVAL + \
+           '])) by (destination_service_name) / sum(irate(istio_requests_total{destination_service_namespace="' + \
+           NAMESPACE + '"}[' + METRIC_TIME_INTERVAL + '])) by (destination_service_name)'
 
-    request_error_rates = pd.DataFrame()
 
-    query = 'sum(irate(istio_requests_total{destination_service_namespace="' + NAMESPACE + \
-            '",response_code!~"200|0|201|207|202"}[' + METRIC_TIME_INTERVAL + \
-            '])) by (destination_service_name) / sum(irate(istio_requests_total{destination_service_namespace="' + \
-            NAMESPACE + '"}[' + METRIC_TIME_INTERVAL + '])) by (destination_service_name)'
-    results = prometheus_query(prom_url, query)
+def get_error_metric_name(config, result_metric):
+    dest_svc = result_metric['destination_service_name']
+    name = "error_" + dest_svc
+    if dest_svc in config["services_skipped"] or not dest_svc.startswith("edgex"):
+        logger.debug(f"Skipped {name}")
+        return None
+    return name
+
+
+def convert_to_error_rates(config, results):
+    request_error_rates = {}
     for result in results:
         # logger.info(result)
-        dest_svc = result['metric']['destination_service_name']
-        name = "error_" + dest_svc
-        error_rate = result['value'][1]
-        if dest_svc in config["services_skipped"] or not dest_svc.startswith("edgex"):
-            logger.debug(f"Skipped {name}")
+        name = get_error_metric_name(config, result['metric'])
+        if name is None:
             continue
-
-        if error_rate == "NaN":
-            error_rate = np.NaN
-        request_error_rates[name] = pd.Series(float(error_rate))
+        request_error_rates[name] = float(result['value'][1])
     return request_error_rates
 
 
+def get_request_error_rates(config):
+    prom_url = config['prometheus_url']
+    query = get_request_error_rates_query()
+    results = prometheus_query(prom_url, query)
+    return convert_to_error_rates(config, results)
+
+
+def get_container_cpu_usages_query():
+    return 'sum(irate(container_cpu_usage_seconds_total{namespace="%s", container!~\'POD|istio-proxy|\'}[%s])) ' \
+           'BY(container) * 100' % (NAMESPACE, METRIC_TIME_INTERVAL)
+
+
+def get_container_availabilities_query():
+    return 'avg_over_time((sum without() (up{namespace="%s"}) or ' \
+           '(0 * sum_over_time(up{namespace="edgex"}[%s])))[%s:5s])' \
+           % (NAMESPACE, METRIC_TIME_INTERVAL, METRIC_TIME_INTERVAL)
+
+
+def get_container_memory_usages_query():
+    return 'sum(container_memory_working_set_bytes{namespace="%s", container!~\'POD|istio-proxy|\'}) ' \
+           'BY(container) / 1000000' % NAMESPACE
+
+
 def get_container_cpu_usages(prom_url):
-    query = 'sum(irate(container_cpu_usage_seconds_total{namespace="%s", container!~\'POD|istio-proxy|\'}[%s])) ' \
-            'BY(container) * 100' % (NAMESPACE, METRIC_TIME_INTERVAL)
+    query = get_container_cpu_usages_query()
     results = prometheus_query(prom_url, query)
     usage_by_container = convert_to_usage_by_container(results)
     return usage_by_container
 
 
 def get_container_availabilities(prom_url):
-    query = 'avg_over_time((sum without() (up{namespace="%s"}) or ' \
-            '(0 * sum_over_time(up{namespace="edgex"}[%s])))[%s:5s])' \
-            % (NAMESPACE, METRIC_TIME_INTERVAL, METRIC_TIME_INTERVAL)
+    query = get_container_availabilities_query()
     results = prometheus_query(prom_url, query)
     availability_by_container = convert_to_availability_by_container(results)
     return availability_by_container
 
 
 def get_container_memory_usages(prom_url):
-    query = 'sum(container_memory_working_set_bytes{namespace="%s", container!~\'POD|istio-proxy|\'}) ' \
-            'BY(container) / 1000000' % NAMESPACE
+    query = get_container_memory_usages_query()
     results = prometheus_query(prom_url, query)
     usage_by_container = convert_to_usage_by_container(results)
     return usage_by_container
@@ -133,10 +168,14 @@ def get_container_memory_usages(prom_url):
 def get_metric_services(config):
     prom_url = config['prometheus_url']
 
-    aggregated_results = {}
     container_availabilities = get_container_availabilities(prom_url)
     container_cpu_usages = get_container_cpu_usages(prom_url)
     container_memory_usages = get_container_memory_usages(prom_url)
+    return aggregate_metric_services(config, container_availabilities, container_cpu_usages, container_memory_usages)
+
+
+def aggregate_metric_services(config, container_availabilities, container_cpu_usages, container_memory_usages):
+    aggregated_results = {}
     container_names = container_cpu_usages.keys() | container_memory_usages.keys() | container_availabilities.keys()
     for container_name in container_names:
         container_usage = {}
@@ -256,9 +295,7 @@ def get_service_graph(prom_url):
         "font_size": 36,
         "edgecolors": 'black'
     }
-    dg.add_edge("edgex-exporter-fledge", "edgex-redis")
-    dg.add_edge("edgex-device-rest", "edgex-core-data")
-    dg.add_edge("edgex-core-metadata", "edgex-device-rest")
+    dg.add_edges_from(KNOWN_SERVICE_LINKS)
     # dg.remove_node("edgex-core-consul")
     mapping = {old_label: old_label.replace("edgex-", "") for old_label in dg.nodes()}
     renamed_graph = nx.relabel_nodes(dg, mapping)
@@ -267,7 +304,55 @@ def get_service_graph(prom_url):
     # nx.draw_networkx(renamed_graph, arrows=True, **options)
     # plt.show()
 
-    filename = 'current_links_mpg.csv'
+    filename = SERVICE_GRAPH_FILENAME
     # df.set_index('timestamp')
     df.to_csv(filename)
     return dg
+
+
+def read_service_graph(filename=SERVICE_GRAPH_FILENAME):
+    links = pd.read_csv(filename)
+    return nx.DiGraph(zip(links["source"], links["destination"]))
+
+
+def split_latency_metric_name(metric_name, services):
+    for service_name in services:
+        source_prefix = f"latency_{service_name}_"
+        if metric_name.startswith(source_prefix) and metric_name[len(source_prefix):] in services:
+            return service_name, metric_name[len(source_prefix):]
+    return None
+
+
+def get_services_of_metric(metric_name, services):
+    # Names are in the training data format, e.g. latency_edgex_ui_edgex_core_data, cpu_edgex_ui or edgex_ui_delay
+    if metric_name.startswith("latency_"):
+        latency_services = split_latency_metric_name(metric_name, services)
+        return set(latency_services) if latency_services else None
+    for prefix in SERVICE_METRIC_PREFIXES:
+        if metric_name.startswith(prefix) and metric_name[len(prefix):] in services:
+            return {metric_name[len(prefix):]}
+    # Longer names first, so a service is never mistaken for another one whose name it starts with
+    for service_name in sorted(services, key=len, reverse=True):
+        if metric_name == service_name or metric_name.startswith(f"{service_name}_"):
+            return {service_name}
+    return None
+
+
+def get_service_graph_from_metrics(metric_names, service_names, service_graph=None):
+    # Latency metrics are named after the calling and the called service, so the training data has the call graph
+    services = {service_name.replace('-', '_') for service_name in service_names}
+    for metric_name in metric_names:
+        for prefix in SERVICE_METRIC_PREFIXES:
+            if metric_name.startswith(prefix):
+                services.add(metric_name[len(prefix):])
+    links = list(KNOWN_SERVICE_LINKS)
+    if service_graph is not None:
+        links.extend(service_graph.edges)
+    graph = nx.DiGraph()
+    graph.add_nodes_from(services)
+    graph.add_edges_from((source.replace('-', '_'), destination.replace('-', '_')) for source, destination in links)
+    for metric_name in metric_names:
+        latency_services = split_latency_metric_name(metric_name, services)
+        if latency_services:
+            graph.add_edge(*latency_services)
+    return graph
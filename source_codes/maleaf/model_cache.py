@@ -0,0 +1,140 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+from contextlib import contextmanager
+from os import path
+
+import pandas as pd
+
+MODEL_CACHE_FOLDER = "structure_models"
+MODEL_CACHE_INDEX_FILENAME = "index.json"
+MODEL_CACHE_SIZE_MB = 500
+# Increased whenever the layout of a cached stage changes, so entries of the older layout are never read
+MODEL_CACHE_FORMAT_VERSION = 2
+# Preprocessing keys are hashed as well, even if their effect is mostly visible in the training matrix already
+TRAINING_CONFIG_KEYS = ["services_for_fault_injection", "services_skipped", "metrics_skipped", "experiments_skipped"]
+# The weak edges of the CBN structure are removed after the model is loaded, so their thresholds are not hashed
+STAGE_CONFIG_KEYS = {
+    "preprocessing": ["number_of_initial_steps", "random_state_discretization"],
+    "svm": ["svm_kernel", "random_state_svm"],
+    "random_forest": ["number_of_trees", "random_state_rf"],
+    "cbn": ["cbn_structure_learning", "service_graph_hops", "service_graph_file"],
+}
+logger = logging.getLogger(__name__)
+
+
+def get_model_cache(config):
+    return ModelCache(config.get("model_cache_folder", MODEL_CACHE_FOLDER),
+                      config.get("model_cache_size_mb", MODEL_CACHE_SIZE_MB))
+
+
+class ModelCache:
+
+    def __init__(self, folder=MODEL_CACHE_FOLDER, max_size_mb=MODEL_CACHE_SIZE_MB):
+        self.folder = folder
+        self.max_size = max_size_mb * 1024 * 1024
+        self.index_filename = path.join(folder, MODEL_CACHE_INDEX_FILENAME)
+
+    @staticmethod
+    def get_key(config, stage, training_data, structure_input=None):
+        hasher = hashlib.sha256()
+        hasher.update(f"{stage}:{MODEL_CACHE_FORMAT_VERSION}".encode())
+        training_config = {key: config.get(key) for key in TRAINING_CONFIG_KEYS + STAGE_CONFIG_KEYS[stage]}
+        hasher.update(json.dumps(training_config, sort_keys=True, default=str).encode())
+        # Inputs read from outside the config, such as the collected service graph, are hashed by their content
+        if structure_input is not None:
+            hasher.update(json.dumps(structure_input, default=str).encode())
+        hasher.update(json.dumps([(column, str(dtype)) for column, dtype in training_data.dtypes.items()]).encode())
+        hasher.update(pd.util.hash_pandas_object(training_data, index=False).to_numpy().tobytes())
+        return hasher.hexdigest()
+
+    def get_filename(self, key):
+        return path.join(self.folder, f"{key}.pickle")
+
+    def read_index(self):
+        if not path.exists(self.index_filename):
+            return {}
+        try:
+            with open(self.index_filename) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            logger.warning(f"Ignoring the unreadable model cache index {self.index_filename}")
+            return {}
+
+    def write_index(self, index):
+        # Replacing the file keeps the index readable even if the process is stopped while writing
+        temporary_filename = f"{self.index_filename}.{os.getpid()}.tmp"
+        with open(temporary_filename, "w") as index_file:
+            json.dump(index, index_file, indent=2)
+        os.replace(temporary_filename, self.index_filename)
+
+    @contextmanager
+    def lock_index(self):
+        # Parallel evaluations share the cache, so every update of the index is serialized between processes
+        os.makedirs(self.folder, exist_ok=True)
+        with open(f"{self.index_filename}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def contains(self, key):
+        with self.lock_index():
+            index = self.read_index()
+            if key not in index or not path.exists(self.get_filename(key)):
+                return False
+            index[key]["last_used"] = time.time()
+            self.write_index(index)
+        logger.info(f"Using the cached {index[key]['stage']} {key} of {index[key]['dataset_tag']}")
+        return True
+
+    def read(self, key):
+        if not self.contains(key):
+            return None
+        # Another process may evict or replace the entry after the index was checked, which is treated as a miss
+        try:
+            with open(self.get_filename(key), "rb") as cached_file:
+                return pickle.load(cached_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            logger.warning(f"Ignoring the unreadable cached entry {key}")
+            return None
+
+    def write(self, key, data):
+        # Replacing the file keeps concurrent readers from loading a partially written pickle
+        os.makedirs(self.folder, exist_ok=True)
+        temporary_filename = f"{self.get_filename(key)}.{os.getpid()}.tmp"
+        with open(temporary_filename, "wb") as cached_file:
+            pickle.dump(data, cached_file)
+        os.replace(temporary_filename, self.get_filename(key))
+
+    def add(self, key, stage, dataset_tag):
+        with self.lock_index():
+            if not path.exists(self.get_filename(key)):
+                return
+            index = self.read_index()
+            index[key] = {"filename": path.basename(self.get_filename(key)),
+                          "stage": stage,
+                          "dataset_tag": dataset_tag,
+                          "size": path.getsize(self.get_filename(key)),
+                          "created": time.time(),
+                          "last_used": time.time()}
+            self.evict(index, key)
+            self.write_index(index)
+
+    def evict(self, index, kept_key):
+        for key in [key for key in index if not path.exists(path.join(self.folder, index[key]["filename"]))]:
+            index.pop(key)
+        total_size = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda key: index[key]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            if key == kept_key:
+                continue
+            logger.info(f"Evicting the cached {index[key]['stage']} {key} of {index[key]['dataset_tag']}")
+            os.remove(path.join(self.folder, index[key]["filename"]))
+            total_size -= index.pop(key)["size"]
@@ -0,0 +1,152 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+try:
+    from sklearn.svm import _libsvm
+    from sklearn.svm._base import LIBSVM_IMPL
+except ImportError:
+    _libsvm = None
+
+# libsvm and the fitted attributes of SVC are private, they are only called directly on the tested releases
+LIBSVM_SKLEARN_VERSIONS = ["1.2"]
+LIBSVM_ATTRIBUTES = ["support_", "support_vectors_", "_n_support", "_dual_coef_", "_intercept_", "_probA", "_probB",
+                     "_impl", "_gamma"]
+logger = logging.getLogger(__name__)
+
+
+class CompiledRandomForest:
+    # The trees are flattened into shared arrays and walked together for one row, predict is the argmax of the same
+    # probabilities, as in RandomForestClassifier.predict
+
+    def __init__(self, classifier):
+        self.classes_ = classifier.classes_
+        self.number_of_trees = len(classifier.estimators_)
+        lefts, rights, features, thresholds, leaf_probabilities, roots = [], [], [], [], [], []
+        offset = 0
+        for estimator in classifier.estimators_:
+            tree = estimator.tree_
+            is_leaf = tree.children_left == -1
+            node_indices = np.arange(tree.node_count) + offset
+            # Leaves point to themselves, so walking max_depth steps leaves every tree on its leaf
+            lefts.append(np.where(is_leaf, node_indices, tree.children_left + offset))
+            rights.append(np.where(is_leaf, node_indices, tree.children_right + offset))
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            # Normalized the same way as DecisionTreeClassifier.predict_proba
+            values = tree.value[:, 0, :classifier.n_classes_]
+            normalizer = values.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            leaf_probabilities.append(values / normalizer)
+            roots.append(offset)
+            offset += tree.node_count
+        self.lefts = np.concatenate(lefts)
+        self.rights = np.concatenate(rights)
+        self.features = np.concatenate(features)
+        self.thresholds = np.concatenate(thresholds)
+        self.leaf_probabilities = np.concatenate(leaf_probabilities)
+        self.roots = np.array(roots)
+        self.max_depth = max(estimator.tree_.max_depth for estimator in classifier.estimators_)
+
+    def predict(self, data):
+        # The trees compare float32 features with float64 thresholds
+        values = np.asarray(data, dtype=np.float32)
+        nodes = self.roots
+        for _ in range(self.max_depth):
+            nodes = np.where(values[self.features[nodes]] <= self.thresholds[nodes], self.lefts[nodes],
+                             self.rights[nodes])
+        # Rows are added one tree after another, in the order of the forest's own accumulation
+        prediction_proba = np.add.reduce(self.leaf_probabilities[nodes], axis=0) / self.number_of_trees
+        return self.classes_[np.argmax(prediction_proba)], prediction_proba
+
+    def predict_batch(self, data):
+        # Every row walks all trees at once, the trees of a row are added in the same order as for a single row
+        values = np.asarray(data, dtype=np.float32)
+        rows = np.arange(len(values))[:, np.newaxis]
+        nodes = np.broadcast_to(self.roots, (len(values), len(self.roots)))
+        for _ in range(self.max_depth):
+            nodes = np.where(values[rows, self.features[nodes]] <= self.thresholds[nodes], self.lefts[nodes],
+                             self.rights[nodes])
+        prediction_probas = np.add.reduce(self.leaf_probabilities[nodes], axis=1) / self.number_of_trees
+        return self.classes_[np.argmax(prediction_probas, axis=1)], prediction_probas
+
+
+class CompiledSVM:
+    # libsvm is called directly with the fitted arrays, without the validation of SVC for every row; predict still
+    # comes from the one-vs-one votes, which can differ from the argmax of the Platt scaled probabilities
+
+    def __init__(self, classifier):
+        self.classes_ = classifier.classes_
+        self.classifier = classifier
+        self.is_compiled = CompiledSVM.is_libsvm_supported(classifier)
+        if not self.is_compiled:
+            logger.warning(f"Predicting with SVC, libsvm is not called directly on scikit-learn {sklearn.__version__}")
+            return
+        self.model_arguments = (classifier.support_, classifier.support_vectors_, classifier._n_support,
+                                classifier._dual_coef_, classifier._intercept_, classifier._probA,
+                                classifier._probB)
+        self.kernel_arguments = {"svm_type": LIBSVM_IMPL.index(classifier._impl),
+                                 "kernel": classifier.kernel,
+                                 "degree": classifier.degree,
+                                 "coef0": classifier.coef0,
+                                 "gamma": classifier._gamma,
+                                 "cache_size": classifier.cache_size}
+
+    @staticmethod
+    def is_libsvm_supported(classifier):
+        minor_version = ".".join(sklearn.__version__.split(".")[:2])
+        return _libsvm is not None and minor_version in LIBSVM_SKLEARN_VERSIONS and \
+            all(hasattr(classifier, attribute) for attribute in LIBSVM_ATTRIBUTES)
+
+    def predict(self, data):
+        predictions, prediction_probas = self.predict_batch(np.reshape(data, (1, -1)))
+        return predictions[0], prediction_probas[0]
+
+    def predict_batch(self, data):
+        if not self.is_compiled:
+            # SVC was fitted on a data frame, the rows get its column names back
+            rows = pd.DataFrame(data, columns=getattr(self.classifier, "feature_names_in_", None))
+            return self.classifier.predict(rows), self.classifier.predict_proba(rows)
+        values = np.ascontiguousarray(data, dtype=np.float64)
+        prediction_probas = _libsvm.predict_proba(values, *self.model_arguments, **self.kernel_arguments)
+        predictions = _libsvm.predict(values, *self.model_arguments, **self.kernel_arguments)
+        return self.classes_[predictions.astype(int)], prediction_probas
+
+
+class ServiceFaultGrouping:
+    # Classes are named <service>_<fault type>, the mapping to services is built once and the probabilities of every
+    # service are summed in one pass
+
+    def __init__(self, classes):
+        fault_classes = [(index, class_[:-2], class_[-1]) for index, class_ in enumerate(classes)
+                         if class_ != "no_fault"]
+        self.service_names = list(dict.fromkeys(service_name for _, service_name, _ in fault_classes))
+        service_positions = {service_name: position for position, service_name in enumerate(self.service_names)}
+        self.class_indices = np.array([index for index, _, _ in fault_classes], dtype=np.intp)
+        self.fault_types = [fault_type for _, _, fault_type in fault_classes]
+        self.class_services = np.array([service_positions[service_name] for _, service_name, _ in fault_classes],
+                                       dtype=np.intp)
+        # Services without any probability share it evenly between their faults
+        self.uniform_distribution = 1 / np.bincount(self.class_services)[self.class_services]
+
+    def get_predictions(self, prediction_proba):
+        # Python's round is kept, np.round is not correctly rounded on ties such as 0.0375
+        fault_probabilities = np.array([round(probability, 3) for probability in
+                                        np.asarray(prediction_proba)[self.class_indices].tolist()])
+        # bincount adds the faults of a service in class order, as the per service loop did, a matrix product could
+        # reorder the sum and move the rounded distribution by 0.001
+        service_probabilities = np.bincount(self.class_services, weights=fault_probabilities,
+                                            minlength=len(self.service_names))
+        class_service_probabilities = service_probabilities[self.class_services]
+        has_probability = class_service_probabilities != 0
+        fault_distributions = np.where(
+            has_probability, fault_probabilities / np.where(has_probability, class_service_probabilities, 1.0),
+            self.uniform_distribution)
+        predictions = [{"service_name": service_name, "probability": round(probability, 3), "fault_distribution": {}}
+                       for service_name, probability in zip(self.service_names, service_probabilities.tolist())]
+        for position, fault_type, probability in zip(self.class_services.tolist(), self.fault_types,
+                                                     fault_distributions.tolist()):
+            predictions[position]["fault_distribution"][fault_type] = round(probability, 3)
+        return predictions
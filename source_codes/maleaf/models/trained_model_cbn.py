@@ -1,14 +1,21 @@
 import logging
 import pickle
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from os import path
 
 import networkx as nx
+import numpy as np
 from causalnex.inference import InferenceEngine
 from causalnex.network import BayesianNetwork
 from causalnex.plots import NODE_STYLE, plot_structure, EDGE_STYLE
+from causalnex.structure import StructureModel
 from causalnex.structure.notears import from_pandas
 
+from metric import get_services_of_metric, get_service_graph_from_metrics, read_service_graph, SERVICE_GRAPH_FILENAME
+from model_cache import get_model_cache
+
 # EXPERIMENTS_SKIPPED = {"cpu": 2, "memory": 3, "availability": 4}
 # METRICS_SKIPPED = ["cpu", "error", "memory", "availability"]
 logger = logging.getLogger(__name__)
@@ -17,17 +24,29 @@ CB_COLOR_CYCLE = ['#377eb8', '#ff7f00', '#4daf4a',
                   '#999999', '#e41a1c', '#dede00']
 
 # TABU_PARENTS = ["edgex_ui", 'edgex-exporter-fledge', 'edgex-support-scheduler']
+INFERENCE_CACHE_SIZE = 1024
+# Either 'exact' or 'likelihood_weighting'
+INFERENCE = "exact"
+APPROXIMATE_INFERENCE_SAMPLES = 5000
+# Seconds, the sample count alone bounds the inference by default, since a time budget makes the results vary with
+# the load of the machine
+APPROXIMATE_INFERENCE_TIME_BUDGET = None
+APPROXIMATE_INFERENCE_BATCH_SIZE = 500
+APPROXIMATE_INFERENCE_RANDOM_STATE = 42
+# Either 'notears' or 'service_graph'
+STRUCTURE_LEARNING = "notears"
+SERVICE_GRAPH_HOPS = 1
 
 
 class TrainedModelCBN:
 
-    def __init__(self, config, clustering_instances, sort_indices, normalization_factors, training_data,
+    def __init__(self, config, threshold_tables, normal_states, feature_schema, training_data,
                  mean_ground_truth_values, dataset_tag=None):
         self.partial_structure_models = None
         self.independent_nodes = []
-        self.normalization_factors = normalization_factors
-        self.sort_indices = sort_indices
-        self.clustering_instances = clustering_instances
+        self.threshold_tables = threshold_tables
+        self.normal_states = normal_states
+        self.feature_schema = feature_schema
         self.training_data = training_data
         self.mean_ground_truth_values = mean_ground_truth_values
         self.dataset_tag = dataset_tag
@@ -36,11 +55,13 @@ class TrainedModelCBN:
             filename = time.strftime("%Y%m%d_%H%M%S") + "_cbn"
         else:
             filename = dataset_tag + "_cbn"
-        if path.exists(f"structure_models/{filename}.pickle"):
-            self.structure_model = TrainedModelCBN.read_from_file(f"structure_models/{filename}.pickle")
-        else:
+        model_cache = get_model_cache(config)
+        cache_key = model_cache.get_key(config, "cbn", training_data, self.get_structure_input(config, training_data))
+        self.structure_model = model_cache.read(cache_key)
+        if self.structure_model is None:
             self.structure_model = self.learn_from_data(config, training_data)
-            TrainedModelCBN.save_data_to_file(self.structure_model, filename=f"structure_models/{filename}.pickle")
+            model_cache.write(cache_key, self.structure_model)
+            model_cache.add(cache_key, "cbn", dataset_tag)
         logger.info(f"Number of edges: {len(self.structure_model.edges)}")
         # self.structure_model.remove_edges_below_threshold(0.01)
         self.remove_weak_edges_from_nodes_with_many_edges(config)
@@ -49,7 +70,7 @@ class TrainedModelCBN:
         self.save_cbn_graph(self.structure_model, filename=filename)
         logger.info("Structure model is constructed.")
         logger.info("Starting to construct inference engine...")
-        self.inference_engines = self.get_inference_engines(self.structure_model, training_data)
+        self.inference_engines = self.get_inference_engines(config, self.structure_model, training_data)
         logger.info("Training complete.")
 
     def remove_independent_nodes(self):
@@ -78,25 +99,47 @@ class TrainedModelCBN:
         for edge_name in edges_to_remove:
             self.structure_model.remove_edge(*edge_name)
 
-    def get_inference_engines(self, structure_model, training_data):
+    def get_inference_engines(self, config, structure_model, training_data):
         inference_engines = []
 
-        self.partial_structure_models = []
-        for component in nx.weakly_connected_components(structure_model):
-            partial_sm = structure_model.copy()
-            for node in structure_model.nodes:
-                if node not in component:
-                    partial_sm.remove_node(node)
-            self.partial_structure_models.append(partial_sm)
-            logger.info(f"{len(component)} -> {component}")
+        self.partial_structure_models = self.get_partial_structure_models(structure_model)
         for partial_sm in self.partial_structure_models:
-            bn = BayesianNetwork(partial_sm)
-            bn.fit_node_states(training_data)
-            bn = bn.fit_cpds(training_data, method="BayesianEstimator", bayes_prior="K2")
-            ie = InferenceEngine(bn)
-            inference_engines.append(ie)
+            logger.info(f"{len(partial_sm)} -> {set(partial_sm.nodes)}")
+        fitting_arguments = [(partial_sm, training_data[list(partial_sm.nodes)])
+                             for partial_sm in self.partial_structure_models]
+        n_workers = config.get("cbn_fitting_workers", 1)
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                self.bayesian_networks = list(executor.map(fit_bayesian_network, *zip(*fitting_arguments)))
+        else:
+            self.bayesian_networks = [fit_bayesian_network(*arguments) for arguments in fitting_arguments]
+        for bn in self.bayesian_networks:
+            if config.get("cbn_inference", INFERENCE) == "likelihood_weighting":
+                ie = ApproximateInferenceEngine(bn,
+                                                config.get("approximate_inference_samples",
+                                                           APPROXIMATE_INFERENCE_SAMPLES),
+                                                config.get("approximate_inference_time_budget",
+                                                           APPROXIMATE_INFERENCE_TIME_BUDGET))
+            else:
+                ie = InferenceEngine(bn)
+            # Every training creates new engines, so no cached result outlives the model it was computed with
+            inference_engines.append(CachedInferenceEngine(ie, config.get("inference_cache_size",
+                                                                          INFERENCE_CACHE_SIZE)))
         return inference_engines
 
+    @staticmethod
+    def get_partial_structure_models(structure_model):
+        # One pass over the nodes and edges keeps their order in every component, as if the others were removed
+        component_indices = {}
+        for index, component in enumerate(nx.weakly_connected_components(structure_model)):
+            component_indices.update(dict.fromkeys(component, index))
+        partial_structure_models = [StructureModel() for _ in range(len(set(component_indices.values())))]
+        for node, node_data in structure_model.nodes(data=True):
+            partial_structure_models[component_indices[node]].add_node(node, **node_data)
+        for parent_node, child_node, edge_data in structure_model.edges(data=True):
+            partial_structure_models[component_indices[parent_node]].add_edge(parent_node, child_node, **edge_data)
+        return partial_structure_models
+
     @staticmethod
     def learn_from_data(config, training_dataframe):
         service_statuses = []
@@ -126,12 +169,81 @@ class TrainedModelCBN:
             if service_status not in training_dataframe.columns:
                 service_statuses.remove(service_status)
         all_metrics = list(set(training_dataframe.columns) - set(service_statuses))
-        sm = from_pandas(training_dataframe, tabu_child_nodes=service_statuses, tabu_parent_nodes=all_metrics,
-                         tabu_edges=tabu_edges, max_iter=1000)
+        structure_learning = config.get("cbn_structure_learning", STRUCTURE_LEARNING)
+        start_time = time.time()
+        if structure_learning == "service_graph":
+            service_graph = TrainedModelCBN.get_service_graph(config, training_dataframe.columns)
+            sm = TrainedModelCBN.learn_from_service_graph(training_dataframe, service_statuses, service_graph,
+                                                          config.get("service_graph_hops", SERVICE_GRAPH_HOPS))
+        else:
+            sm = from_pandas(training_dataframe, tabu_child_nodes=service_statuses, tabu_parent_nodes=all_metrics,
+                             tabu_edges=tabu_edges, max_iter=1000)
+        logger.info(f"Structure learning with {structure_learning} found {len(sm.edges)} edges "
+                    f"in {time.time() - start_time:.2f} seconds")
         n_components = nx.number_weakly_connected_components(sm)
         logger.info(f"Number of independent subgraphs: {n_components}")
         return sm
 
+    @staticmethod
+    def get_structure_input(config, training_data):
+        # The service graph file can change without the training data, so its links are part of the cache key
+        if config.get("cbn_structure_learning", STRUCTURE_LEARNING) != "service_graph":
+            return None
+        service_graph = TrainedModelCBN.get_service_graph(config, training_data.columns)
+        return {"nodes": sorted(service_graph.nodes), "edges": sorted(service_graph.edges)}
+
+    @staticmethod
+    def get_service_graph(config, metric_names):
+        # The links collected by metric.get_service_graph are added to the ones seen in the training data
+        service_graph_filename = config.get("service_graph_file", SERVICE_GRAPH_FILENAME)
+        collected_service_graph = read_service_graph(service_graph_filename) \
+            if path.exists(service_graph_filename) else None
+        return get_service_graph_from_metrics(metric_names, config["services_for_fault_injection"],
+                                              collected_service_graph)
+
+    @staticmethod
+    def get_candidate_parents(columns, service_statuses, service_graph, hops=SERVICE_GRAPH_HOPS):
+        # Only the statuses of services that are at most hops calls away can be the parents of a metric
+        undirected_service_graph = service_graph.to_undirected(as_view=True)
+        services = set(service_graph.nodes)
+        candidate_parents = {column: [] for column in columns if column not in service_statuses}
+        for service_status in service_statuses:
+            status_services = get_services_of_metric(service_status, services)
+            nearby_services = None
+            if status_services:
+                nearby_services = set()
+                for service_name in status_services:
+                    nearby_services.update(nx.single_source_shortest_path_length(undirected_service_graph,
+                                                                                 service_name, cutoff=hops))
+            for metric_name, parents in candidate_parents.items():
+                metric_services = get_services_of_metric(metric_name, services)
+                if nearby_services is None or metric_services is None or metric_services & nearby_services:
+                    parents.append(service_status)
+        return candidate_parents
+
+    @staticmethod
+    def learn_from_service_graph(training_dataframe, service_statuses, service_graph, hops=SERVICE_GRAPH_HOPS):
+        # With statuses as the only parents and metrics as the only children the graph can't have a cycle, so the
+        # NOTEARS optimum is the least squares fit of every metric on its candidate parents
+        columns = list(training_dataframe.columns)
+        column_indices = {column: index for index, column in enumerate(columns)}
+        data = training_dataframe.to_numpy(dtype=float)
+        weights = np.zeros((len(columns), len(columns)))
+        candidate_parents = TrainedModelCBN.get_candidate_parents(columns, service_statuses, service_graph, hops)
+        for metric_name, parents in candidate_parents.items():
+            if not parents:
+                continue
+            parent_indices = [column_indices[parent] for parent in parents]
+            weights[parent_indices, column_indices[metric_name]] = \
+                np.linalg.lstsq(data[:, parent_indices], data[:, column_indices[metric_name]], rcond=None)[0]
+        logger.info(f"Service graph leaves {sum(len(parents) for parents in candidate_parents.values())} of "
+                    f"{len(service_statuses) * len(candidate_parents)} candidate edges")
+        sm = StructureModel()
+        sm.add_nodes_from(columns)
+        sm.add_weighted_edges_from([(columns[parent_index], columns[child_index], weights[parent_index, child_index])
+                                    for parent_index, child_index in zip(*np.nonzero(weights))], origin="learned")
+        return sm
+
     @staticmethod
     def save_cbn_graph(sm, filename=None):
         if filename is None:
@@ -202,3 +314,130 @@ class TrainedModelCBN:
         logger.info(f"Reading model from {filename}")
         with open(filename, "rb") as sm_file:
             return pickle.load(sm_file)
+
+
+def fit_bayesian_network(partial_sm, training_data):
+    bn = BayesianNetwork(partial_sm)
+    bn.fit_node_states(training_data)
+    return bn.fit_cpds(training_data, method="BayesianEstimator", bayes_prior="K2")
+
+
+class CachedInferenceEngine:
+
+    def __init__(self, inference_engine, cache_size=INFERENCE_CACHE_SIZE):
+        self.inference_engine = inference_engine
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # Everything except the cached query is served by the wrapped engine, e.g. its _cpds
+        if name == "inference_engine":
+            raise AttributeError(name)
+        return getattr(self.inference_engine, name)
+
+    def query(self, observations=None, parallel=False, num_cores=None):
+        evidence = tuple(sorted(observations.items())) if observations else ()
+        if evidence in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(evidence)
+            return dict(self.cache[evidence])
+        self.misses += 1
+        result = self.inference_engine.query(observations, parallel=parallel, num_cores=num_cores)
+        self.cache[evidence] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return dict(result)
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class ApproximateInferenceEngine:
+    # Likelihood weighting: the unobserved nodes are sampled from their CPDs in topological order and every sample
+    # is weighted by the likelihood of the observations, so the cost grows with the samples instead of the cliques
+
+    def __init__(self, bn, sample_size=APPROXIMATE_INFERENCE_SAMPLES, time_budget=APPROXIMATE_INFERENCE_TIME_BUDGET,
+                 batch_size=APPROXIMATE_INFERENCE_BATCH_SIZE, random_state=APPROXIMATE_INFERENCE_RANDOM_STATE):
+        self.sample_size = sample_size
+        self.time_budget = time_budget
+        self.batch_size = batch_size
+        self.random_state = random_state
+        # Only the keys are read outside, e.g. by filter_columns_by_inference_engine
+        self._cpds = bn.cpds
+        self.nodes = list(nx.topological_sort(bn.structure))
+        self.states = {node: list(cpd.index) for node, cpd in bn.cpds.items()}
+        self.state_indices = {node: {state: index for index, state in enumerate(states)}
+                              for node, states in self.states.items()}
+        self.parents = {}
+        self.parent_cardinalities = {}
+        self.tables = {}
+        for node, cpd in bn.cpds.items():
+            self.parents[node], self.parent_cardinalities[node], self.tables[node] = self.get_table(node, cpd)
+        self.log_tables = {node: np.log(table) for node, table in self.tables.items()}
+
+    def get_table(self, node, cpd):
+        # Columns of the table are ordered by np.ravel_multi_index over the state indices of the parents
+        parents = [parent for parent in cpd.columns.names if parent is not None]
+        if not parents:
+            return [], [], cpd.to_numpy()[:, :1]
+        parent_cardinalities = [len(self.states[parent]) for parent in parents]
+        parent_states = cpd.columns.to_frame(index=False)
+        column_indices = np.ravel_multi_index([parent_states[parent].map(self.state_indices[parent]).to_numpy()
+                                               for parent in parents], parent_cardinalities)
+        table = np.zeros((len(self.states[node]), int(np.prod(parent_cardinalities))))
+        table[:, column_indices] = cpd.to_numpy()
+        return parents, parent_cardinalities, table
+
+    def sample(self, rng, number_of_samples, observed_indices):
+        samples = {}
+        log_weights = np.zeros(number_of_samples)
+        for node in self.nodes:
+            if self.parents[node]:
+                columns = np.ravel_multi_index([samples[parent] for parent in self.parents[node]],
+                                               self.parent_cardinalities[node])
+            else:
+                columns = np.zeros(number_of_samples, dtype=int)
+            if node in observed_indices:
+                samples[node] = np.full(number_of_samples, observed_indices[node])
+                log_weights += self.log_tables[node][observed_indices[node], columns]
+            else:
+                cumulative_probabilities = self.tables[node][:, columns].cumsum(axis=0)
+                thresholds = rng.random(number_of_samples) * cumulative_probabilities[-1]
+                samples[node] = (cumulative_probabilities < thresholds).sum(axis=0)
+        return samples, log_weights
+
+    def query(self, observations=None, parallel=False, num_cores=None):
+        observations = observations or {}
+        observed_indices = {node: self.state_indices[node][state] for node, state in observations.items()}
+        # Without a time budget, the same observations always get the same samples, so the results don't depend on the
+        # query order. With a time budget, the number of samples and so the results depend on the load of the machine
+        rng = np.random.default_rng(self.random_state)
+        all_samples = []
+        all_log_weights = []
+        number_of_samples = 0
+        start_time = time.perf_counter()
+        while number_of_samples < self.sample_size:
+            batch_size = min(self.batch_size, self.sample_size - number_of_samples)
+            samples, log_weights = self.sample(rng, batch_size, observed_indices)
+            all_samples.append(samples)
+            all_log_weights.append(log_weights)
+            number_of_samples += batch_size
+            if self.time_budget and time.perf_counter() - start_time > self.time_budget:
+                logger.debug(f"Approximate inference stopped after {number_of_samples} samples")
+                break
+        log_weights = np.concatenate(all_log_weights)
+        weights = np.exp(log_weights - log_weights.max())
+        results = {}
+        for node in self._cpds:
+            if node in observations:
+                results[node] = {state: float(state == observations[node]) for state in self.states[node]}
+                continue
+            node_samples = np.concatenate([samples[node] for samples in all_samples])
+            probabilities = np.bincount(node_samples, weights=weights, minlength=len(self.states[node]))
+            probabilities /= probabilities.sum()
+            results[node] = dict(zip(self.states[node], probabilities.tolist()))
+        return results
@@ -5,22 +5,25 @@ import time
 import random
 
 import numpy as np
-import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.tree import export_graphviz
 
+from data_manipulation import expand_samples_by_fault
+from model_cache import get_model_cache
+from models.compiled_predictor import CompiledRandomForest, ServiceFaultGrouping
+
 logger = logging.getLogger(__name__)
 
 
 class TrainedModelRandomForest:
 
-    def __init__(self, config, clustering_instances, sort_indices, normalization_factors, training_data,
+    def __init__(self, config, threshold_tables, normal_states, feature_schema, training_data,
                  mean_ground_truth_values, dataset_tag=None):
         self.partial_structure_models = None
         self.independent_nodes = []
-        self.normalization_factors = normalization_factors
-        self.sort_indices = sort_indices
-        self.clustering_instances = clustering_instances
+        self.threshold_tables = threshold_tables
+        self.normal_states = normal_states
+        self.feature_schema = feature_schema
         self.training_data = training_data
         self.mean_ground_truth_values = mean_ground_truth_values
         self.dataset_tag = dataset_tag
@@ -31,15 +34,18 @@ class TrainedModelRandomForest:
             filename = time.strftime("%Y%m%d_%H%M%S") + "_random_forest"
         else:
             filename = dataset_tag + "_random_forest"
-        if os.path.exists(f"structure_models/{filename}.pickle"):
-            self.structure_model = TrainedModelRandomForest.read_from_file(f"structure_models/{filename}.pickle")
-        else:
+        model_cache = get_model_cache(config)
+        cache_key = model_cache.get_key(config, "random_forest", training_data)
+        self.structure_model = model_cache.read(cache_key)
+        if self.structure_model is None:
             self.structure_model = self.learn_from_data(config, training_data, self.all_service_statuses)
-            TrainedModelRandomForest.save_data_to_file(self.structure_model,
-                                                       filename=f"structure_models/{filename}.pickle")
+            model_cache.write(cache_key, self.structure_model)
+            model_cache.add(cache_key, "random_forest", dataset_tag)
             self.save_example_tree(config, self.structure_model,
                                    training_data.drop(columns=self.all_service_statuses).columns, filename=filename)
         logger.info("Structure model is constructed.")
+        self.predictor = CompiledRandomForest(self.structure_model)
+        self.service_fault_grouping = ServiceFaultGrouping(self.structure_model.classes_)
         logger.info("Training complete.")
 
     @staticmethod
@@ -57,41 +63,15 @@ class TrainedModelRandomForest:
 
     @staticmethod
     def learn_from_data(config, training_dataframe, all_service_statuses):
-        Y = []
-        X = pd.DataFrame(columns=training_dataframe.columns)
-
-        for index, row in training_dataframe.iterrows():
-            error_classes = []
-            for service_status in all_service_statuses.copy():
-                fault_status = row[service_status]
-                if fault_status != 0:
-                    error_classes = np.append(error_classes, service_status + '_' + str(fault_status))
-
-            if len(error_classes) == 0:
-                Y = np.append(Y, 'no_fault')
-                X = X.append(row)
-
-            for error_class in error_classes:
-                Y = np.append(Y, error_class)
-                X = X.append(row)
-
-        X = X.drop(columns=all_service_statuses)
+        X, Y = expand_samples_by_fault(training_dataframe, all_service_statuses)
 
         classifier = RandomForestClassifier(n_estimators=config["number_of_trees"],
                                             random_state=config["random_state_rf"])
         classifier.fit(X, Y)
 
-        matched = 0
-        for index, row in X.iterrows():
-            actual = Y[index]
-            predicted = classifier.predict([row.values])
-            match = actual == predicted
-            if match:
-                matched += 1
-
-        accuracy = matched / int(config["number_of_training_data"])
-        logger.info('Accuracy of training set on trained model: ' + str(accuracy) + ' for rows: ' +
-                    str(config["number_of_training_data"]))
+        matched = np.count_nonzero(classifier.predict(X) == Y)
+        accuracy = matched / Y.size
+        logger.info('Accuracy of training set on trained model: ' + str(accuracy) + ' for rows: ' + str(Y.size))
         return classifier
 
     @staticmethod
@@ -5,16 +5,21 @@ import argparse
 import logging
 import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
 
+import numpy as np
 import pandas as pd
 import requests
 import yaml
 
 from chaos_mesh_utils import get_chaos_experiments, add_chaos_mesh_experiment_delay, \
     add_chaos_mesh_experiment_cpu, add_chaos_mesh_experiment_failure, add_chaos_mesh_experiment_memory
-from data_manipulation import fill_empty_cells_with_ground_truth_data
+from data_manipulation import fill_empty_cells_with_ground_truth_data, FAULT_STATUS
+from dataset_storage import ArrowDatasetWriter, ARROW_FILE_EXTENSION, get_schema, read_dataset
 from lasm_utils import send_metrics
-from metric import get_response_times, get_request_error_rates, get_metric_services
+from metric import get_response_times, get_request_error_rates, get_metric_services, get_container_availabilities, \
+    get_container_cpu_usages, get_container_memory_usages, aggregate_metric_services
 
 # MAX_NUMBER_OF_CONCURRENT_FAULT_INJECTIONS = 1
 
@@ -23,14 +28,19 @@ experiment_methods = [add_chaos_mesh_experiment_delay, add_chaos_mesh_experiment
                       add_chaos_mesh_experiment_memory, add_chaos_mesh_experiment_failure]
 # kubectl get nodes -o wide | awk -F ' ' '{print $1 " : " $6":9100"}'
 
-FAULT_STATUS = {"delay": 1, "cpu": 2, "memory": 3, "failure": 4}
 LOG_LEVEL = "INFO"
 TIME_FORMAT = '%H:%M:%S'
 LOGGING_FORMAT = "%(asctime)s.%(msecs)03d-> %(message)s"
 
+METRIC_QUERY_WORKERS = 5
+# Waiting time after fault injection before the metrics of the step are retrieved
+FAULT_SAMPLE_DELAY = 60
+EXPERIMENT_LOG_COLUMNS = ["step", "service", "fault_type", "start_time", "end_time"]
+
 len_second = 60
 logger = logging.getLogger(__name__)
 session = requests.Session()
+metric_query_executor = ThreadPoolExecutor(max_workers=METRIC_QUERY_WORKERS, thread_name_prefix="metric_query")
 
 
 def parse_args():
@@ -48,12 +58,53 @@ def parse_args():
     return parser.parse_args()
 
 
+def timed_query(query_durations, query_name, query_method, *args):
+    query_start_time = time.time()
+    try:
+        return query_method(*args)
+    finally:
+        query_durations[query_name] = time.time() - query_start_time
+
+
+def log_query_durations(query_durations, total_duration):
+    slowest_query = max(query_durations, key=query_durations.get)
+    duration_text = ", ".join(f"{query_name}={duration:.3f}s" for query_name, duration in query_durations.items())
+    logger.info(f"Metric retrieval took {total_duration:.3f}s (slowest: {slowest_query}) [{duration_text}]")
+
+
 def get_metrics(config):
-    latency_df_source = get_response_times(config)
-    request_error_rates = get_request_error_rates(config)
-    service_dict_temp = get_metric_services(config)
+    if config.get("concurrent_metric_collection", False):
+        return get_metrics_concurrently(config)
+    query_durations = {}
+    retrieval_start_time = time.time()
+    latency_values = timed_query(query_durations, "latency", get_response_times, config)
+    request_error_rates = timed_query(query_durations, "error", get_request_error_rates, config)
+    service_dict_temp = timed_query(query_durations, "services", get_metric_services, config)
+    log_query_durations(query_durations, time.time() - retrieval_start_time)
+
+    return latency_values, service_dict_temp, request_error_rates
+
+
+def get_metrics_concurrently(config):
+    prom_url = config['prometheus_url']
+    query_durations = {}
+    retrieval_start_time = time.time()
+    latency_future = metric_query_executor.submit(timed_query, query_durations, "latency", get_response_times,
+                                                  config)
+    error_future = metric_query_executor.submit(timed_query, query_durations, "error", get_request_error_rates,
+                                                config)
+    availability_future = metric_query_executor.submit(timed_query, query_durations, "availability",
+                                                       get_container_availabilities, prom_url)
+    cpu_future = metric_query_executor.submit(timed_query, query_durations, "cpu", get_container_cpu_usages, prom_url)
+    memory_future = metric_query_executor.submit(timed_query, query_durations, "memory", get_container_memory_usages,
+                                                 prom_url)
+    latency_values = latency_future.result()
+    request_error_rates = error_future.result()
+    service_dict_temp = aggregate_metric_services(config, availability_future.result(), cpu_future.result(),
+                                                  memory_future.result())
+    log_query_durations(query_durations, time.time() - retrieval_start_time)
 
-    return latency_df_source, service_dict_temp, request_error_rates
+    return latency_values, service_dict_temp, request_error_rates
 
 
 def wait_rest_of_interval_time(start_time, interval_time):
@@ -67,46 +118,84 @@ def store_metrics_to_files(dataframe_to_save, training_data_filename):
     # dataframe_to_save.to_html(f'{training_data_filename}.html')
 
 
+def record_experiments(experiment_log_filename, step_no, services_with_anomaly, start_times, end_time):
+    if not experiment_log_filename:
+        return
+    if not path.exists(experiment_log_filename):
+        with open(experiment_log_filename, "w") as log_file:
+            log_file.write(",".join(EXPERIMENT_LOG_COLUMNS) + "\n")
+    with open(experiment_log_filename, "a") as log_file:
+        for service_name, fault_status in services_with_anomaly.items():
+            log_file.write(f"{step_no},{service_name},{fault_status},{start_times[service_name]:.3f},{end_time:.3f}\n")
+
+
 def get_step_data(config, services_with_anomaly):
-    latency_df_source, service_dict_temp, request_error_rates = get_metrics(config)
-    service_metrics_frame = pd.DataFrame()
-    service_dict = {}
+    latency_values, service_dict_temp, request_error_rates = get_metrics(config)
+    return create_row_dataframe(latency_values, service_dict_temp, request_error_rates, services_with_anomaly)
 
+
+def create_row_dataframe(latency_values, service_dict_temp, request_error_rates, services_with_anomaly):
+    metric_values = dict(latency_values)
+    timestamp = metric_values.pop('timestamp', None)
+    service_statuses = {}
+    column_names = list(metric_values)
     for service_name, service_metrics in service_dict_temp.items():
-        if service_name in service_dict:
-            service_dict[service_name] = pd.concat([service_dict[service_name], service_metrics], ignore_index=True)
-        else:
-            service_dict[service_name] = service_metrics
+        service_statuses[service_name] = services_with_anomaly[service_name] \
+            if service_name in services_with_anomaly else 0
+        column_names.append(service_name)
         for metric_name, metric in service_metrics.items():
-            service_abnormality = services_with_anomaly[service_name] if service_name in services_with_anomaly else 0
-            service_metrics_frame[service_name] = service_abnormality
-            service_metrics_frame[metric_name + "_" + service_name] = pd.Series(metric)
-    row_dataframe = pd.concat([latency_df_source, service_metrics_frame, request_error_rates], axis=1)
+            metric_values[metric_name + "_" + service_name] = metric
+            column_names.append(metric_name + "_" + service_name)
+    metric_values.update(request_error_rates)
+    column_names.extend(request_error_rates)
+    # Metrics and service statuses are built as one block each, then put into the collection order
+    metric_frame = pd.DataFrame(np.array([list(metric_values.values())], dtype=float), columns=list(metric_values))
+    status_frame = pd.DataFrame(np.array([list(service_statuses.values())], dtype=int).reshape(1, -1),
+                                columns=list(service_statuses))
+    row_dataframe = pd.concat([metric_frame, status_frame], axis=1)[column_names]
+    if timestamp is not None:
+        row_dataframe.insert(0, 'timestamp', pd.Series([timestamp]).astype('datetime64[s]'))
     return row_dataframe
 
 
+def get_mean_ground_truth_values(ground_truth_dataframe):
+    mean_ground_truth_values = {}
+    for column in ground_truth_dataframe.columns:
+        if column != "timestamp":
+            mean_ground_truth_values[column] = ground_truth_dataframe[column].mean()
+    return mean_ground_truth_values
+
+
 def loop_retrieve_training_step(config):
     initialization_start_time = time.strftime("%Y%m%d-%H%M%S")
-    training_data_filename = f"dataset/training_data_{initialization_start_time}.csv"
+    training_data_filename = config.get("resume_training_data") or \
+        f"dataset/training_data_{initialization_start_time}{ARROW_FILE_EXTENSION}"
+    experiment_log_filename = path.splitext(training_data_filename.replace("training_data_", "experiment_log_"))[0] \
+        + ".csv"
     number_of_training_data = config['number_of_training_data']
     number_of_initial_steps = config['number_of_initial_steps']
     step_interval = config['step_interval']
-    columns_to_skip = []
     mean_ground_truth_values = {}
+    # Ground truth steps are kept in memory until the schema of the dataset is fixed
     all_dataframe = pd.DataFrame()
+    dataset_writer = None
     event_counter = 0
     step_no = 0
-    while True:
+    if path.exists(training_data_filename):
+        dataset_writer = ArrowDatasetWriter(training_data_filename)
+        step_no = dataset_writer.number_of_rows
+        event_counter = max(0, step_no - number_of_initial_steps) * config["number_of_concurrent_faults"]
+        mean_ground_truth_values = get_mean_ground_truth_values(
+            read_dataset(training_data_filename).head(number_of_initial_steps))
+        logger.info(f"Resuming data collection from step #{step_no}")
+    while step_no < number_of_training_data:
         try:
             logger.info(f"Starting step #{step_no}")
-            row_dataframe, event_counter = retrieve_training_step(config, step_no, event_counter)
+            row_dataframe, event_counter = retrieve_training_step(config, step_no, event_counter,
+                                                                  experiment_log_filename)
             step_start_time = time.time()
-            processed_dataframe = row_dataframe.drop(
-                columns=set(columns_to_skip).intersection(set(row_dataframe.columns)))
 
-            all_dataframe = pd.concat([all_dataframe, processed_dataframe], ignore_index=True)
-
-            if step_no + 1 > number_of_initial_steps:
+            if dataset_writer:
                 # Print anomaly detections during fault injections
                 # anomaly_states_by_metric, clustering_instances, sort_indices, normalization_factors = birch_ad(all_dataframe)
                 # abnormal_metrics = []
@@ -116,38 +205,35 @@ def loop_retrieve_training_step(config):
                 # logger.info(f"Anomalies:\n {abnormal_metrics}")
                 # if abnormal_metrics:
                 #     logger.info(all_dataframe[abnormal_metrics])
-                pass
-            elif step_no + 1 == number_of_initial_steps:
-                logger.info("Initial ground truth data is collected.")
-                for column in all_dataframe.columns.copy():
-                    if len(pd.unique(all_dataframe[column])) == 1 and pd.isnull(all_dataframe[column][0]):
-                        # Remove columns only with null value
-                        columns_to_skip.append(column)
-                        all_dataframe.pop(column)
-                    elif column != "timestamp":
-                        column_mean_value = all_dataframe[column].mean()
-                        mean_ground_truth_values[column] = column_mean_value
-                        # all_dataframe[column].fillna(column_mean_value, inplace=True)
-                # logger.info("Columns with only NaN values are removed and NaN values are filled with mean.")
-                logger.info("Columns with only NaN values are removed.")
-            store_metrics_to_files(all_dataframe, training_data_filename)
-            last_metrics = all_dataframe.iloc[-1].copy()
+                last_metrics = dataset_writer.append(row_dataframe).iloc[-1].copy()
+            else:
+                all_dataframe = pd.concat([all_dataframe, row_dataframe], ignore_index=True)
+                if step_no + 1 >= number_of_initial_steps:
+                    logger.info("Initial ground truth data is collected.")
+                    # Remove columns only with null value
+                    all_dataframe = all_dataframe.dropna(axis=1, how="all")
+                    logger.info("Columns with only NaN values are removed.")
+                    mean_ground_truth_values = get_mean_ground_truth_values(all_dataframe)
+                    dataset_writer = ArrowDatasetWriter(training_data_filename, get_schema(all_dataframe))
+                    dataset_writer.append(all_dataframe)
+                last_metrics = all_dataframe.iloc[-1].copy()
             fill_empty_cells_with_ground_truth_data(last_metrics, mean_ground_truth_values)
             last_metrics["timestamp"] = last_metrics["timestamp"].strftime('%Y-%m-%d %H:%M:%S')
             send_metrics(last_metrics, config['lasm_server_urls'], config['reporting_identifier'])
             wait_rest_of_interval_time(step_start_time, step_interval)
             step_no += 1
-            if step_no >= number_of_training_data:
-                logger.info(f"Completing data collection after step #{step_no}")
-                config["training_data"] = [training_data_filename]
-                break
         except Exception:
             logger.exception("Error during loop_retrieve_training_step")
+    logger.info(f"Completing data collection after step #{step_no}")
+    if dataset_writer:
+        dataset_writer.close()
+    config["training_data"] = [training_data_filename]
 
 
-def retrieve_training_step(config, step_no, event_counter):
+def retrieve_training_step(config, step_no, event_counter, experiment_log_filename=None):
     number_of_initial_steps = config['number_of_initial_steps']
     services_with_anomaly = {}
+    injection_start_times = {}
     if step_no < number_of_initial_steps:
         logger.info(f"Initialization step #{step_no}")
     else:
@@ -155,7 +241,7 @@ def retrieve_training_step(config, step_no, event_counter):
         if active_experiments:
             time.sleep(5)
             logger.info(f"There are active experiments:{active_experiments}")
-            return retrieve_training_step(config, step_no, event_counter)
+            return retrieve_training_step(config, step_no, event_counter, experiment_log_filename)
         # else:
         # number_of_concurrent_injections = random.randint(1, MAX_NUMBER_OF_CONCURRENT_FAULT_INJECTIONS)
         # selected_services = random.sample(SERVICES_FOR_FAULT_INJECTION, number_of_concurrent_injections)
@@ -180,11 +266,14 @@ def retrieve_training_step(config, step_no, event_counter):
                 # Additional experiments are randomized.
                 selected_experiment_index = random.randint(0, len(available_experiments) - 1)
             event_counter += 1
+            injection_start_times[selected_service] = time.time()
             experiment_methods[FAULT_STATUS[available_experiments[selected_experiment_index]] - 1](selected_service,
                                                                                                    event_counter)
             services_with_anomaly[selected_service] = FAULT_STATUS[available_experiments[selected_experiment_index]]
         logger.info(f"Anomaly selection for experiment step #{experiment_step_no}: {services_with_anomaly}")
-        time.sleep(60)
+        time.sleep(FAULT_SAMPLE_DELAY)
+        record_experiments(experiment_log_filename, step_no, services_with_anomaly, injection_start_times,
+                           time.time())
     row_dataframe = get_step_data(config, services_with_anomaly)
     return row_dataframe, event_counter
 
@@ -1,11 +1,14 @@
 import logging
 import time
 
+import numpy as np
 import requests
 import yaml
 
 import config as c
 
+AVAILABILITY_METRIC_PREFIX = "availability_"
+LATENCY_METRIC_PREFIX = "latency_"
 logger = logging.getLogger(__name__)
 
 
@@ -50,6 +53,56 @@ def get_service_level_agreements(trails_yaml_data):
     return service_level_agreements
 
 
+class SLAViolationChecker:
+    # The SLOs are bound to the metrics of the feature schema once, so a step is checked with one comparison
+
+    def __init__(self, service_level_agreements, features):
+        self.metrics = []
+        self.services = []
+        self.violation_types = []
+        lower_bounds = []
+        upper_bounds = []
+        for metric in features:
+            if metric.startswith(AVAILABILITY_METRIC_PREFIX):
+                service_name = metric[len(AVAILABILITY_METRIC_PREFIX):]
+                violation_type, bound_name = "availability", "min"
+            elif metric.startswith(LATENCY_METRIC_PREFIX):
+                # Latency metrics are named after the calling and the called service, the called one is responsible
+                service_name = "edgex" + metric.split("edgex")[-1]
+                violation_type, bound_name = "max_service_delay", "max"
+            else:
+                continue
+            if bound_name not in service_level_agreements.get(service_name, {}).get(violation_type, {}):
+                continue
+            bound = service_level_agreements[service_name][violation_type][bound_name]
+            self.metrics.append(metric)
+            self.services.append(service_name)
+            self.violation_types.append(violation_type)
+            lower_bounds.append(bound if bound_name == "min" else -np.inf)
+            upper_bounds.append(bound if bound_name == "max" else np.inf)
+        self.lower_bounds = np.array(lower_bounds, dtype=float)
+        self.upper_bounds = np.array(upper_bounds, dtype=float)
+        self.expected_values = [service_level_agreements[service_name][violation_type]
+                                for service_name, violation_type in zip(self.services, self.violation_types)]
+        self.providers = [service_level_agreements[service_name]['provider'] for service_name in self.services]
+        logger.info(f"Compiled {len(self.metrics)} SLO checks for {len(set(self.services))} services")
+
+    def get_violations(self, raw_step_data, discrete_test_step_data):
+        # Only metrics that are out of their normal state are checked, a missing metric is never violated
+        raw_values = np.array([raw_step_data.get(metric, np.nan) for metric in self.metrics], dtype=float)
+        states = np.array([discrete_test_step_data.get(metric, 0) for metric in self.metrics], dtype=float)
+        is_violated = (states != 0) & ((raw_values < self.lower_bounds) | (raw_values > self.upper_bounds))
+        violations = {"availability": {}, "max_service_delay": {}}
+        for position in np.flatnonzero(is_violated).tolist():
+            violations[self.violation_types[position]][self.services[position]] = {
+                "violation_type": self.violation_types[position],
+                "reported_value": raw_step_data[self.metrics[position]],
+                "expected_value": self.expected_values[position],
+                "responsible_provider": self.providers[position]
+            }
+        return violations["max_service_delay"], violations["availability"]
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=getattr(logging, c.LOG_LEVEL),
                         format=c.LOGGING_FORMAT, datefmt=c.TIME_FORMAT)
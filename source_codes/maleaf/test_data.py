@@ -1,20 +1,22 @@
 import json
 import logging
-from datetime import datetime
+import os
+import time
+from datetime import datetime, timedelta
 from os import path
 
 import pandas as pd
 import yaml
-from pandas import Series
 import numpy as np
 
 from anomaly_detection import discretize_with_trained_mode
 from rca import get_step_data
-from data_manipulation import filter_columns_by_inference_engine, remove_columns_unavailable_on_training_data, \
-    remove_previously_deleted_columns
+from data_manipulation import filter_columns_by_inference_engine, remove_columns_unavailable_on_training_data
 from generate_model import filter_data, get_raw_data
 from lasm_utils import send_incident
 
+RESULT_FILE_EXTENSION = ".jsonl"
+RECORD_READ_BLOCK_SIZE = 1024 * 1024
 logger = logging.getLogger(__name__)
 
 
@@ -34,6 +36,40 @@ def read_json_from_file(filename):
         return json.load(outfile)
 
 
+def append_json_line(record_file, data):
+    record_file.write(json.dumps(data) + "\n")
+    record_file.flush()
+
+
+def read_last_line(filename):
+    with open(filename, "rb") as record_file:
+        position = record_file.seek(0, os.SEEK_END)
+        tail = b""
+        while position > 0 and b"\n" not in tail.rstrip(b"\n"):
+            block_size = min(RECORD_READ_BLOCK_SIZE, position)
+            position -= block_size
+            record_file.seek(position)
+            tail = record_file.read(block_size) + tail
+    return tail.rstrip(b"\n").rsplit(b"\n", 1)[-1]
+
+
+def count_complete_lines(filename):
+    # A line cut off by a stopped test is dropped, so the test step is repeated when the test is resumed
+    number_of_lines = 0
+    end_of_last_line = 0
+    position = 0
+    with open(filename, "rb+") as record_file:
+        for block in iter(lambda: record_file.read(RECORD_READ_BLOCK_SIZE), b""):
+            number_of_lines += block.count(b"\n")
+            if b"\n" in block:
+                end_of_last_line = position + block.rindex(b"\n") + 1
+            position += len(block)
+        if end_of_last_line != position:
+            logger.warning(f"Removing the incomplete last line of {filename}")
+            record_file.truncate(end_of_last_line)
+    return number_of_lines
+
+
 def print_row_with_discrete_value(series_data, discrete_values):
     table_text = "\n"
     for column, value in series_data.items():
@@ -45,8 +81,18 @@ def print_row_with_discrete_value(series_data, discrete_values):
     logger.info(f"Row to be checked:{table_text}")
 
 
-def check_metrics(config, trained_model, new_step_data, sla_data=None):
-    query_results = {}
+def is_in_normal_state(discrete_data, normal_states):
+    # A metric missing from the step, e.g. a series that disappeared during a failure, is never in its normal state
+    return all(metric in discrete_data and discrete_data[metric] == state for metric, state in normal_states.items())
+
+
+def get_normal_state_predictions(config, trained_model):
+    service_names = [service_name.replace('-', '_') for service_name in config["services_for_fault_injection"]]
+    return [{"service_name": service_name, "probability": 0.0, "fault_distribution": {}}
+            for service_name in service_names if service_name in trained_model.training_data.columns]
+
+
+def check_metrics(config, trained_model, new_step_data, sla_checker=None, discrete_states=None):
     analysis_start_time = datetime.now().strftime("%m/%d/%Y %H:%M:%S.%f")
     # logger.info(f"Row to be checked:\n{new_step_data}")
     for column in new_step_data.index.copy():
@@ -55,93 +101,72 @@ def check_metrics(config, trained_model, new_step_data, sla_data=None):
                 new_step_data.pop(column)
         except:
             print("")
-    metric_retrieval_time = new_step_data["timestamp"]
-    if isinstance(metric_retrieval_time, datetime):
-        metric_retrieval_time = metric_retrieval_time.strftime('%Y-%m-%d %H:%M:%S')
+    metric_retrieval_time = get_metric_retrieval_time(new_step_data["timestamp"])
     new_step_data.pop("timestamp")
-    discrete_test_step_data = new_step_data.copy()
-    discrete_data_by_metric = discretize_with_trained_mode(new_step_data, trained_model)
-    for metric, states in discrete_data_by_metric.items():
-        for step_no, state in enumerate(states):
-            if isinstance(discrete_test_step_data, Series):
-                discrete_test_step_data[metric] = state
-            else:
-                discrete_test_step_data.loc[step_no, metric] = state
-    discrete_test_step_data.astype("int32")
-    print_row_with_discrete_value(new_step_data, discrete_test_step_data)
-    # logger.info(f"Row to be checked after anomaly detection:\n{discrete_test_step_data}")
+    if discrete_states is None:
+        discrete_states = discretize_with_trained_mode(new_step_data.to_frame().T, trained_model).iloc[0]
+    raw_step_data = new_step_data.to_dict()
+    discrete_test_step_data = get_discrete_step_data(raw_step_data, discrete_states.to_dict())
+    return analyze_step(config, trained_model, metric_retrieval_time, raw_step_data, discrete_test_step_data,
+                        analysis_start_time, sla_checker=sla_checker)
+
+
+def get_metric_retrieval_time(timestamp):
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    return timestamp
+
+
+def get_discrete_step_data(raw_step_data, discrete_states):
+    discrete_test_step_data = dict(raw_step_data)
+    discrete_test_step_data.update((metric, state) for metric, state in discrete_states.items()
+                                   if metric in discrete_test_step_data)
+    return discrete_test_step_data
+
 
-    discrete_test_step_data = discrete_test_step_data.to_dict()
+def remove_independent_nodes(trained_model, discrete_test_step_data):
     for node_name in trained_model.independent_nodes:
         if node_name in discrete_test_step_data:
             discrete_test_step_data.pop(node_name)
-    delay_violations = {}
-    availability_violations = {}
-    for metric_name, state in discrete_test_step_data.items():
-        if metric_name.startswith('availability') and state != 0:
-            raw_value = new_step_data[metric_name]
-            related_service_name = metric_name.lstrip("availability_")
-            if related_service_name in sla_data and raw_value < sla_data[related_service_name]['availability']["min"]:
-                availability_violations[related_service_name] = {
-                    "violation_type": 'availability',
-                    "reported_value": raw_value,
-                    "expected_value": sla_data[related_service_name]['availability'],
-                    "responsible_provider": sla_data[related_service_name]['provider']
-                }
-        elif metric_name.startswith('latency') and state != 0:
-            raw_value = new_step_data[metric_name]
-            related_service_name = "edgex" + metric_name.split("edgex")[-1]
-            if related_service_name in sla_data and \
-                    raw_value > sla_data[related_service_name]['max_service_delay']["max"]:
-                delay_violations[related_service_name] = {
-                    "violation_type": 'max_service_delay',
-                    "reported_value": raw_value,
-                    "expected_value": sla_data[related_service_name]['max_service_delay'],
-                    "responsible_provider": sla_data[related_service_name]['provider']
+
+
+def is_rca_skipped(config, trained_model, discrete_test_step_data):
+    # Only the live loop skips steps, archive evaluations analyze every step so their KPIs cover all of them
+    if not config.get("skip_rca_in_normal_state") or config["use_archive"]:
+        return False
+    normal_states = {metric: state for metric, state in trained_model.normal_states.items()
+                     if metric not in trained_model.independent_nodes}
+    return is_in_normal_state(discrete_test_step_data, normal_states)
+
+
+def analyze_step(config, trained_model, metric_retrieval_time, raw_step_data, discrete_test_step_data,
+                 analysis_start_time, sla_checker=None, model_output=None):
+    query_results = {}
+    print_row_with_discrete_value(raw_step_data, discrete_test_step_data)
+    # logger.info(f"Row to be checked after anomaly detection:\n{discrete_test_step_data}")
+
+    remove_independent_nodes(trained_model, discrete_test_step_data)
+    if is_rca_skipped(config, trained_model, discrete_test_step_data):
+        logger.info("All metrics are in their normal states, root cause analysis is skipped")
+        return {"predictions": get_normal_state_predictions(config, trained_model),
+                "violation_time": metric_retrieval_time,
+                "analysis_start_time": analysis_start_time,
+                "root_cause_analysis_time": datetime.now().strftime("%m/%d/%Y %H:%M:%S.%f"),
+                "discrete_data": discrete_test_step_data,
+                "raw_data": raw_step_data,
                 }
+    delay_violations, availability_violations = ({}, {}) if sla_checker is None else \
+        sla_checker.get_violations(raw_step_data, discrete_test_step_data)
 
     rca_algorithm = config['rca_algorithm']
     if rca_algorithm in ('svm', 'random_forest'):
-        data = np.array([], dtype=int)
-        for column in trained_model.all_metrics:
-            if column in discrete_test_step_data:
-                data = np.append(data, discrete_test_step_data[column])
-            else:
-                data = np.append(data, 0)
-
-        prediction = trained_model.structure_model.predict([data])[0]
-        prediction_proba = trained_model.structure_model.predict_proba([data])[0]
+        if model_output is None:
+            data = np.array([discrete_test_step_data.get(column, 0) for column in trained_model.all_metrics])
+            model_output = trained_model.predictor.predict(data)
+        prediction, prediction_proba = model_output
         root_cause_analysis_time = datetime.now().strftime("%m/%d/%Y %H:%M:%S.%f")
 
-        classes = np.array(trained_model.structure_model.classes_)
-        predictions = []
-        i = 0
-        for class_ in classes:
-            if class_ != "no_fault":
-                service_name = class_[:-2]
-                if not [x for x in predictions if x['service_name'] == service_name]:
-                    predictions.append(
-                        {"service_name": service_name, "probability": 0.0,
-                         "fault_distribution": {}})
-                for j in range(0, len(predictions)):
-                    if predictions[j]['service_name'] == service_name:
-                        predictions[j]['fault_distribution'][class_[-1]] = float(f"{prediction_proba[i]:.3f}")
-                        break
-            i = i + 1
-
-        for i in range(0, len(predictions)):
-            probability_of_service = 0.0
-            for fault_type in predictions[i]['fault_distribution']:
-                probability_of_service = probability_of_service + predictions[i]['fault_distribution'][fault_type]
-            for fault_type in predictions[i]['fault_distribution']:
-                if probability_of_service == 0:
-                    predictions[i]['fault_distribution'][fault_type] =\
-                        round(1 / len(predictions[i]['fault_distribution']), 3)
-                else:
-                    predictions[i]['fault_distribution'][fault_type] = \
-                        round(predictions[i]['fault_distribution'][fault_type] / probability_of_service, 3)
-            predictions[i]['probability'] = round(probability_of_service, 3)
-
+        predictions = trained_model.service_fault_grouping.get_predictions(prediction_proba)
         predictions = sorted(predictions, key=lambda i: i['probability'], reverse=True)
         result_table = "\n"
         for result in predictions:
@@ -179,7 +204,7 @@ def check_metrics(config, trained_model, new_step_data, sla_data=None):
                 "analysis_start_time": analysis_start_time,
                 "root_cause_analysis_time": root_cause_analysis_time,
                 "discrete_data": discrete_test_step_data,
-                "raw_data": new_step_data.to_dict(),
+                "raw_data": raw_step_data,
                 }
 
     elif rca_algorithm == 'cbn':
@@ -187,6 +212,10 @@ def check_metrics(config, trained_model, new_step_data, sla_data=None):
             partial_test_data = filter_columns_by_inference_engine(discrete_test_step_data, inference_engine)
             query_result = inference_engine.query(partial_test_data, parallel=True)
             query_results.update(query_result)
+        if logger.isEnabledFor(logging.DEBUG):
+            # The summary walks every engine, so it is only built when it is logged
+            logger.debug(f"Inference cache hits/misses: "
+                         f"{[(engine.hits, engine.misses) for engine in trained_model.inference_engines]}")
         predictions = []
         for metric, result in query_results.items():
             if metric.startswith("edgex"):
@@ -238,46 +267,105 @@ def check_metrics(config, trained_model, new_step_data, sla_data=None):
                 "analysis_start_time": analysis_start_time,
                 "root_cause_analysis_time": root_cause_analysis_time,
                 "discrete_data": discrete_test_step_data,
-                "raw_data": new_step_data.to_dict(),
+                "raw_data": raw_step_data,
                 }
     else:
         logger.error('rca algorithm not specified')
 
 
-def test_stored_data(config, trained_model, training_completion_time=None, training_dataset_tag=None, sla_data=None):
-    start_row = 0
-    all_test_data, test_dataset_tag = get_raw_data(config, is_test_data=True)
+def get_record_filename(config, test_dataset_tag, training_dataset_tag=None):
     if training_dataset_tag:
         test_dataset_tag = f"{training_dataset_tag}_{test_dataset_tag}"
     # if config["test_false_positive"]:
     #     test_dataset_tag += "_false_positive"
-    record_filename = f"{config['output_folder']}/{test_dataset_tag}_{config['rca_algorithm']}.json"
-    if path.exists(record_filename):
-        all_results = read_json_from_file(record_filename)
-        start_row = len(all_results["test_results"])
-    else:
-        all_results = {"training_completion_time": training_completion_time, "test_results": []}
+    return f"{config['output_folder']}/{test_dataset_tag}_{config['rca_algorithm']}{RESULT_FILE_EXTENSION}"
+
+
+def is_test_completed(record_filename):
+    # The last line of a finished result file is the completion record
+    if not path.exists(record_filename) or not path.getsize(record_filename):
+        return False
+    try:
+        return json.loads(read_last_line(record_filename)).get("completed", False)
+    except ValueError:
+        return False
+
+
+def get_actual_results(test_data):
+    fault_columns = [column for column in test_data if column.startswith('edgex')]
+    return [{column: value for column, value in test_step.items() if value != 0}
+            for test_step in test_data[fault_columns].to_dict("records")]
+
+
+def predict_test_steps(config, trained_model, discrete_test_steps):
+    # The classifiers predict every step that is not skipped in one call, the CBN queries stay per step
+    model_outputs = [None] * len(discrete_test_steps)
+    if config['rca_algorithm'] not in ('svm', 'random_forest'):
+        return model_outputs
+    analyzed_positions = [position for position, discrete_test_step_data in enumerate(discrete_test_steps)
+                          if not is_rca_skipped(config, trained_model, discrete_test_step_data)]
+    if analyzed_positions:
+        data = np.array([[discrete_test_steps[position].get(column, 0) for column in trained_model.all_metrics]
+                         for position in analyzed_positions])
+        predictions, prediction_probas = trained_model.predictor.predict_batch(data)
+        for position, prediction, prediction_proba in zip(analyzed_positions, predictions, prediction_probas):
+            model_outputs[position] = (prediction, prediction_proba)
+    return model_outputs
+
+
+def test_stored_data(config, trained_model, training_completion_time=None, training_dataset_tag=None,
+                     sla_checker=None):
+    all_test_data, test_dataset_tag = get_raw_data(config, is_test_data=True)
+    record_filename = get_record_filename(config, test_dataset_tag, training_dataset_tag)
+    # The result file starts with a header line, then has one line per test step and a completion line at the end
+    number_of_lines = count_complete_lines(record_filename) if path.exists(record_filename) else 0
+    if number_of_lines and is_test_completed(record_filename):
+        logger.info(f"Testing of the given dataset is already completed in {record_filename}")
+        return record_filename
+    start_row = max(number_of_lines - 1, 0)
     all_test_data = filter_data(config, all_test_data)
     all_test_data.columns = all_test_data.columns.str.replace('-', '_')
     all_test_data = remove_columns_unavailable_on_training_data(all_test_data, trained_model.training_data)
-    for index, test_step in all_test_data.iterrows():
-        logger.info(f"Test step #{index}")
-        if index < start_row:
-            continue
-        actual_faulty_service_columns = [col for col in all_test_data if
-                                         col.startswith('edgex') and test_step[col] != 0]
-        actual_results = test_step[actual_faulty_service_columns]
-        test_step = remove_previously_deleted_columns(test_step)
-        results = check_metrics(config, trained_model, test_step, sla_data=sla_data)
-        results["actual_results"] = actual_results.to_dict()
-        all_results["test_results"].append(results)
-        if not actual_results.empty:
-            logger.info(f"Actual results:\n{actual_results.to_string()}\n")
-        else:
-            logger.info("There was no fault injection")
-        save_json_to_file(record_filename, all_results)
+    all_test_data = all_test_data[all_test_data.index >= start_row]
+
+    # Every stage runs over the whole test set, only the result records are assembled step by step
+    actual_results = get_actual_results(all_test_data)
+    step_data = all_test_data.drop(columns=[column for column in all_test_data if column.startswith('edgex')])
+    metric_retrieval_times = [get_metric_retrieval_time(timestamp) for timestamp in step_data["timestamp"]]
+    step_data = step_data.drop(columns="timestamp")
+    discrete_test_data = discretize_with_trained_mode(step_data, trained_model)
+    raw_test_steps = step_data.to_dict("records")
+    discrete_test_steps = [get_discrete_step_data(raw_step_data, discrete_states) for raw_step_data, discrete_states
+                           in zip(raw_test_steps, discrete_test_data.to_dict("records"))]
+    for discrete_test_step_data in discrete_test_steps:
+        remove_independent_nodes(trained_model, discrete_test_step_data)
+    inference_start_time = time.time()
+    model_outputs = predict_test_steps(config, trained_model, discrete_test_steps)
+    # The analysis time of a step includes its share of the batch inference
+    inference_time_per_step = (time.time() - inference_start_time) / max(
+        sum(model_output is not None for model_output in model_outputs), 1)
+
+    with open(record_filename, "a") as record_file:
+        if not number_of_lines:
+            append_json_line(record_file, {"training_completion_time": training_completion_time})
+        for position, index in enumerate(all_test_data.index):
+            logger.info(f"Test step #{index}")
+            analysis_start_time = datetime.now()
+            if model_outputs[position] is not None:
+                analysis_start_time -= timedelta(seconds=inference_time_per_step)
+            results = analyze_step(config, trained_model, metric_retrieval_times[position], raw_test_steps[position],
+                                   discrete_test_steps[position],
+                                   analysis_start_time.strftime("%m/%d/%Y %H:%M:%S.%f"), sla_checker=sla_checker,
+                                   model_output=model_outputs[position])
+            results["actual_results"] = actual_results[position]
+            append_json_line(record_file, results)
+            if actual_results[position]:
+                logger.info(f"Actual results: {actual_results[position]}\n")
+            else:
+                logger.info("There was no fault injection")
+        append_json_line(record_file, {"completed": True})
     logger.info("Completed testing the given dataset")
-    return all_results
+    return record_filename
 
 
 if __name__ == '__main__':